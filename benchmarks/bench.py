@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# bench.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Measure Imaginer's own overhead against the local stand-in server.
+
+Every scenario runs in a fresh interpreter, so that startup time and
+the memory high-water mark are its own:
+
+    startup   import the command line and list the providers
+    provider  call a Hugging Face provider's ask() directly
+    openai    call the OpenAI provider's ask() (needs the openai module)
+    generate  run 'imaginer generate' in-process, cache off
+
+Pass --output to keep the numbers as JSON and compare them across
+commits.
+"""
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mockserver import MockConfig, MockServer, parse_errors
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+SCENARIOS = ("startup", "provider", "openai", "generate")
+
+
+def source_package(directory):
+    """Lay src/ out as an importable `imaginer` package under `directory`.
+
+    constants.py is normally generated by meson; a benchmark app id keeps
+    the cache, queue and index apart from the real ones.
+    """
+    package = os.path.join(directory, "imaginer")
+    os.makedirs(package)
+    for name in os.listdir(SRC):
+        if name.endswith(".py") or name == "provider":
+            os.symlink(os.path.join(SRC, name), os.path.join(package, name))
+    with open(os.path.join(SRC, "constants.py.in")) as f:
+        constants = f.read()
+    constants = constants.replace("@APP_ID@", "page.codeberg.Imaginer.Imaginer.Benchmark")
+    constants = constants.replace("@VERSION@", "benchmark")
+    with open(os.path.join(package, "constants.py"), "w") as f:
+        f.write(constants)
+    return directory
+
+
+def max_rss():
+    """Return the memory high-water mark of this process, in MiB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def timed_calls(fn, requests, concurrency):
+    """Call `fn(i)` `requests` times and return the latencies and error counts."""
+    latencies = []
+    errors = {}
+
+    def call(i):
+        start = time.monotonic()
+        try:
+            fn(i)
+        except Exception as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+        else:
+            latencies.append(time.monotonic() - start)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, range(requests)))
+    return latencies, errors
+
+
+def run_scenario(args):
+    """Body of a scenario, in the child interpreter. Prints its result as JSON."""
+    output = tempfile.mkdtemp(prefix="imaginer-bench-")
+    result = {}
+    start = time.monotonic()
+
+    if args.run == "startup":
+        from imaginer import cli
+
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                cli.main(["--list-providers"])
+            finally:
+                sys.stdout = stdout
+
+    elif args.run in ("provider", "openai"):
+        from imaginer.provider import PROVIDERS
+
+        try:
+            provider = PROVIDERS.instance("stablediffusion" if args.run == "provider" else "openai")
+        except ImportError as e:
+            print(json.dumps({"skipped": str(e)}))
+            return
+        provider.load({"api_key": "benchmark"})
+        latencies, errors = timed_calls(
+            lambda i: provider.ask(f"benchmark {i}", "", os.path.join(output, f"{i}.png")),
+            args.requests,
+            args.concurrency,
+        )
+        result.update(latencies=latencies, errors=errors)
+
+    elif args.run == "generate":
+        from imaginer import cli
+
+        prompts = [f"benchmark {i}" for i in range(args.requests)]
+        with open(os.devnull, "w") as devnull:
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = sys.stderr = devnull
+            try:
+                cli.main([
+                    "-p", "stablediffusion", "--api-key", "benchmark",
+                    "-j", str(args.concurrency), "-o", output, *prompts,
+                ])
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+        latencies = []
+        errors = {}
+        with open(os.path.join(output, "manifest.jsonl")) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["status"] == "done":
+                    latencies.append(entry["elapsed"])
+                else:
+                    errors[entry["status"]] = errors.get(entry["status"], 0) + 1
+        result.update(latencies=latencies, errors=errors)
+
+    result.update(wall=time.monotonic() - start, max_rss=max_rss())
+    print(json.dumps(result))
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+
+def summarize(name, result, elapsed):
+    if "skipped" in result:
+        return {"scenario": name, "skipped": result["skipped"]}
+    latencies = result.get("latencies", [])
+    summary = {
+        "scenario": name,
+        "process_seconds": round(elapsed, 3),
+        "max_rss_mib": round(result["max_rss"], 1),
+        "errors": result.get("errors", {}),
+    }
+    if latencies:
+        summary.update(
+            requests=len(latencies),
+            throughput=round(len(latencies) / result["wall"], 2),
+            p50=round(percentile(latencies, 0.5), 4),
+            p95=round(percentile(latencies, 0.95), 4),
+            p99=round(percentile(latencies, 0.99), 4),
+        )
+    return summary
+
+
+def print_table(summaries):
+    print(f"{'scenario':<10} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'process':>8} {'rss MiB':>8}  errors")
+    for s in summaries:
+        if "skipped" in s:
+            print(f"{s['scenario']:<10} skipped: {s['skipped']}")
+            continue
+        print(
+            f"{s['scenario']:<10} {s.get('throughput', '-'):>8} {s.get('p50', '-'):>8} {s.get('p95', '-'):>8}"
+            f" {s.get('p99', '-'):>8} {s['process_seconds']:>8} {s['max_rss_mib']:>8}  {s['errors'] or ''}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("-n", "--requests", type=int, default=50)
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5, help="runs of the startup scenario")
+    parser.add_argument("--latency", type=float, default=0.0, help="server latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--size", type=int, default=512 * 1024, help="bytes per image")
+    parser.add_argument("--errors", type=parse_errors, default={}, help="e.g. 429=0.1,503=0.05")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--run", choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_scenario(args)
+        return 0
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}")
+
+    config = MockConfig(args.latency, args.jitter, args.size, args.errors, estimated_time=0.5)
+    server = MockServer(config).start()
+    workdir = tempfile.mkdtemp(prefix="imaginer-bench-")
+    env = dict(
+        os.environ,
+        PYTHONPATH=source_package(os.path.join(workdir, "lib")),
+        IMAGINER_HF_API_URL=server.url,
+        OPENAI_API_BASE=f"{server.url}/v1",
+        XDG_CACHE_HOME=os.path.join(workdir, "cache"),
+        XDG_DATA_HOME=os.path.join(workdir, "data"),
+    )
+
+    summaries = []
+    for name in args.scenarios or SCENARIOS:
+        runs = args.repeat if name == "startup" else 1
+        timings = []
+        for _ in range(runs):
+            start = time.monotonic()
+            child = subprocess.run(
+                [sys.executable, __file__, "--run", name,
+                 "-n", str(args.requests), "-c", str(args.concurrency)],
+                env=env, capture_output=True, text=True,
+            )
+            timings.append(time.monotonic() - start)
+            if child.returncode != 0:
+                sys.exit(f"{name} failed:\n{child.stderr}")
+            result = json.loads(child.stdout.strip().splitlines()[-1])
+        summaries.append(summarize(name, result, statistics.median(timings)))
+
+    server.stop()
+    print_table(summaries)
+    print(f"{server.requests} requests served from {server.url}", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(config), "results": summaries}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
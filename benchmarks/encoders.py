@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# encoders.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+
+"""Compare the output encoders: time to encode against size on disk.
+
+Every format of the Output preferences is tried at a few settings on the
+same image, through the code the post-processing stage runs, metadata
+included:
+
+    python3 encoders.py --image some-output.png --repeat 5
+
+Without --image, a synthetic 1024x1024 picture with smooth gradients and
+fine noise stands in for a generated one. Needs Pillow; AVIF also needs
+a Pillow built with libavif.
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+
+from bench import source_package
+
+SETTINGS = [
+    ("png", {"compression": 1}),
+    ("png", {"compression": 6}),
+    ("png", {"compression": 9}),
+    ("jpg", {"quality": 85}),
+    ("jpg", {"quality": 95}),
+    ("webp", {"quality": 80}),
+    ("webp", {"quality": 90}),
+    ("avif", {"quality": 60}),
+    ("avif", {"quality": 80}),
+]
+
+
+def synthetic(size):
+    from PIL import Image
+
+    gradient = Image.merge("RGB", (
+        Image.linear_gradient("L").resize((size, size)),
+        Image.radial_gradient("L").resize((size, size)),
+        Image.linear_gradient("L").rotate(90).resize((size, size)),
+    ))
+    noise = Image.effect_noise((size, size), 24).convert("RGB")
+    detail = Image.effect_mandelbrot((size, size), (-2.0, -1.5, 1.0, 1.5), 64).convert("RGB")
+    return Image.blend(Image.blend(gradient, detail, 0.3), noise, 0.15)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", help="image to encode, instead of a synthetic one")
+    parser.add_argument("--size", type=int, default=1024, help="side of the synthetic image")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, source_package(tempfile.mkdtemp(prefix="imaginer-bench-")))
+    from PIL import Image
+
+    from imaginer.postprocess import PostProcessOptions, encode
+
+    source = Image.open(args.image) if args.image else synthetic(args.size)
+    source.load()
+    info = {"prompt": "benchmark", "negative_prompt": "", "provider": "benchmark", "model": ""}
+
+    results = []
+    print(f"{'format':<6} {'setting':<16} {'ms':>8} {'KiB':>8}")
+    for format, setting in SETTINGS:
+        options = PostProcessOptions(metadata="embed", format=format, **setting)
+        timings = []
+        try:
+            for _ in range(args.repeat):
+                start = time.monotonic()
+                data = encode(source, format, options, info, source)
+                timings.append(time.monotonic() - start)
+        except (KeyError, OSError) as e:
+            print(f"{format:<6} skipped: {e!r}")
+            continue
+        label = " ".join(f"{key}={value}" for key, value in setting.items())
+        ms = statistics.median(timings) * 1000
+        print(f"{format:<6} {label:<16} {ms:>8.1f} {len(data) / 1024:>8.1f}")
+        results.append({"format": format, **setting, "ms": round(ms, 2), "bytes": len(data)})
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"image": args.image or f"synthetic {args.size}px", "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# mockserver.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Local stand-in for the Hugging Face inference API and OpenAI images API.
+
+Point the providers at it with:
+
+    IMAGINER_HF_API_URL=http://127.0.0.1:8080
+    OPENAI_API_BASE=http://127.0.0.1:8080/v1
+"""
+
+import argparse
+import base64
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def png(size, width=64, height=64):
+    """Return a valid PNG of about `size` bytes.
+
+    The image itself is tiny; the rest is an ancillary chunk that
+    decoders skip, so the payload size can be set independently.
+    """
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    header = chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+    rows = (b"\0" + b"\x80" * width * 3) * height
+    image = chunk(b"IDAT", zlib.compress(rows))
+    end = chunk(b"IEND", b"")
+    data = b"\x89PNG\r\n\x1a\n" + header + image
+    padding = max(0, size - len(data) - len(end) - 12)
+    if padding:
+        data += chunk(b"prIv", random.randbytes(padding))
+    return data + end
+
+
+class MockConfig:
+    """How the stand-in behaves: latency, payload size and injected errors.
+
+    `errors` maps an HTTP status (403, 429 or 503) to the probability of
+    answering with it instead of an image.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, size=512 * 1024, errors=None, estimated_time=2.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.size = size
+        self.errors = errors or {}
+        self.estimated_time = estimated_time
+
+    def delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def error(self):
+        roll = random.random()
+        for status, probability in sorted(self.errors.items()):
+            if roll < probability:
+                return status
+            roll -= probability
+        return None
+
+
+def parse_errors(value):
+    """Parse `429=0.1,503=0.05` into `{429: 0.1, 503: 0.05}`."""
+    errors = {}
+    for item in filter(None, value.split(",")):
+        status, probability = item.split("=")
+        errors[int(status)] = float(probability)
+    return errors
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real services
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_image(self, compute=0.0):
+        body = self.server.image
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-compute-time", f"{compute:.3f}")
+        self.end_headers()
+        for i in range(0, len(body), 64 * 1024):
+            self.wfile.write(body[i : i + 64 * 1024])
+
+    def send_error_status(self, status):
+        if self.path.startswith("/v1/"):
+            self.send_openai_error(status)
+        elif status == 503:
+            self.send_json(503, {
+                "error": "Model is currently loading",
+                "estimated_time": self.config.estimated_time,
+            })
+        elif status == 429:
+            self.send_json(429, {"error": "Rate limit reached"}, {"Retry-After": "1"})
+        else:
+            self.send_json(status, {"error": "Authorization header is invalid"})
+
+    def send_openai_error(self, status):
+        """The same errors, in the shape of the OpenAI API the SDK parses."""
+        if status == 503:
+            error = ("The server is overloaded or not ready yet.", "server_error", None)
+            headers = None
+        elif status == 429:
+            error = ("Rate limit reached for requests", "requests", "rate_limit_exceeded")
+            headers = {"Retry-After": "1"}
+        else:
+            error = ("Incorrect API key provided", "invalid_request_error", "invalid_api_key")
+            headers = None
+        message, kind, code = error
+        self.send_json(status, {"error": {"message": message, "type": kind, "param": None, "code": code}}, headers)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path.startswith("/status/"):
+            self.send_json(200, {"loaded": True, "state": "Loadable"})
+        elif self.path.startswith("/files/"):
+            self.send_image()
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        body = self.read_body()
+        self.server.count()
+        delay = self.config.delay()
+        time.sleep(delay)
+        status = self.config.error()
+        if status is not None:
+            self.send_error_status(status)
+        elif self.path.startswith("/models/"):
+            if body.get("options", {}).get("wait_for_model") is False and body.get("inputs") == "warm up":
+                self.send_json(200, [{"generated_text": ""}])
+            else:
+                self.send_image(compute=delay)
+        elif self.path.rstrip("/").endswith("/images/generations"):
+            count = int(body.get("n", 1))
+            if body.get("response_format") == "b64_json":
+                data = [{"b64_json": self.server.image_b64}] * count
+            else:
+                host = self.headers.get("Host")
+                data = [{"url": f"http://{host}/files/{i}.png"} for i in range(count)]
+            self.send_json(200, {"created": int(time.time()), "data": data})
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+
+class MockServer(ThreadingHTTPServer):
+    """The stand-in, to be run in a thread of the benchmark or on its own."""
+
+    daemon_threads = True
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        super().__init__((host, port), Handler)
+        self.config = config or MockConfig()
+        self.image = png(self.config.size)
+        self.image_b64 = base64.b64encode(self.image).decode("ascii")
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True, name="mockserver").start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds added to the latency")
+    parser.add_argument("--size", type=int, default=512 * 1024, help="bytes per image")
+    parser.add_argument("--errors", type=parse_errors, default={}, help="e.g. 429=0.1,503=0.05,403=0.01")
+    parser.add_argument("--estimated-time", type=float, default=2.0, help="estimated_time sent with 503")
+    args = parser.parse_args()
+
+    config = MockConfig(args.latency, args.jitter, args.size, args.errors, args.estimated_time)
+    server = MockServer(config, port=args.port)
+    print(f"Serving on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# cache.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from .xdg import cache_dir
+
+TMP_PREFIX = ".part-"  # entries being written, never evicted
+
+
+class ResultCache:
+    """Content-addressed store of generated images with LRU eviction.
+
+    Entries are plain files named after the hash of everything that
+    influences the output. The modification time doubles as the LRU clock:
+    it is bumped on every hit, and the oldest files go first once the
+    cache grows past `max_size` bytes. The total size is counted once and
+    then kept up to date, so only eviction walks the directory, and it
+    frees a tenth of the cache at a time.
+    """
+
+    def __init__(self, directory=None, max_size=512 * 1024 * 1024):
+        self.directory = directory or cache_dir("results")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(provider, prompt, negative_prompt, params=None):
+        data = json.dumps(
+            {
+                "provider": provider.slug,
+                "model": provider.model,
+                "prompt": prompt,
+                "negative_prompt": negative_prompt or "",
+                "params": params or {},
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Return the cached bytes for `key`, or None on a miss."""
+        entry = self._entry(key)
+        try:
+            with open(entry, "rb") as f:
+                data = f.read()
+            os.utime(entry)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        entry = self._entry(key)
+        try:
+            replaced = os.stat(entry).st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=TMP_PREFIX, dir=os.path.dirname(entry))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, entry)
+        except OSError:
+            os.unlink(tmp)
+            raise
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data) - replaced
+        if self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith(TMP_PREFIX):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                yield os.path.join(root, name), stat.st_size, stat.st_mtime
+
+    @property
+    def size(self):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self.entries())
+            return self._size
+
+    def evict(self):
+        with self._lock:
+            entries = sorted(self.entries(), key=lambda entry: entry[2])
+            total = sum(size for _, size, _ in entries)
+            target = self.max_size * 0.9
+            for path, size, _ in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._size = total
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            self._size = 0
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses, {self.size // 1024} KiB"
@@ -0,0 +1,276 @@
+# cli.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+
+"""Headless image generation, `imaginer generate`.
+
+Nothing in here may import Gtk, Adw or WebKit: only Gio is used, and only
+to read the API keys saved by the application.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import wait
+
+from .cache import ResultCache
+from .generation import Generator, output_base
+from .index import PromptIndex
+from .postprocess import PostProcessOptions, PostProcessor
+from .jobs import JobEngine, JobState
+from .provider import PROVIDERS
+from .provider.ratelimit import RateLimiter
+from .provider.retry import RetryScheduler
+from .provider.transport import transport
+from .routing import AUTO
+from .usage import UsageLedger
+
+SCHEMA_ID = "page.codeberg.Imaginer.Imaginer"
+
+
+def load_settings():
+    """Return the application's GSettings, or None if they are unavailable."""
+    try:
+        from gi.repository import Gio
+    except ImportError:
+        return None
+    source = Gio.SettingsSchemaSource.get_default()
+    if source is None or source.lookup(SCHEMA_ID, True) is None:
+        return None
+    return Gio.Settings(schema_id=SCHEMA_ID)
+
+
+def read_prompts(args):
+    """Yield prompt dictionaries from the arguments and the JSONL file."""
+    for prompt in args.prompt:
+        yield {"prompt": prompt}
+    if args.file:
+        with open(args.file) if args.file != "-" else sys.stdin as f:
+            for number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise SystemExit(f"{args.file}:{number}: {e}")
+                if isinstance(item, str):
+                    item = {"prompt": item}
+                if not isinstance(item, dict) or "prompt" not in item:
+                    raise SystemExit(f"{args.file}:{number}: missing 'prompt'")
+                yield item
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="imaginer generate",
+        description="Generate images without opening a window.",
+    )
+    parser.add_argument("prompt", nargs="*", help="prompts to generate")
+    parser.add_argument(
+        "-f", "--file",
+        help="JSONL file with one prompt per line, either a string or an object "
+        'with "prompt" and optional "negative_prompt", "provider" and "count"',
+    )
+    parser.add_argument("-p", "--provider", help="provider to use (default: the last one used)")
+    parser.add_argument("-n", "--negative-prompt", default="", help="negative prompt")
+    parser.add_argument("-c", "--count", type=int, default=1, help="images per prompt")
+    parser.add_argument("-o", "--output", default=".", help="output directory")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="concurrent requests")
+    parser.add_argument("--api-key", help="API key, instead of the saved one")
+    parser.add_argument("--force", action="store_true", help="skip the result cache")
+    parser.add_argument("--list-providers", action="store_true", help="list providers and exit")
+    return parser.parse_args(argv)
+
+
+class Runner:
+    def __init__(self, args, settings):
+        self.args = args
+        self.settings = settings
+        self.providers_data = {}
+        cache = None
+        retry = None
+        limiter = None
+        postprocess = None
+        if settings is not None:
+            self.providers_data = settings.get_value("providers-data").unpack()
+            transport.configure(
+                pool_size=max(args.jobs, settings.get_int("http-pool-size")),
+                connect_timeout=settings.get_double("http-connect-timeout"),
+                read_timeout=settings.get_double("http-read-timeout"),
+                http2=settings.get_boolean("http2"),
+            )
+            if settings.get_boolean("cache-enabled"):
+                cache = ResultCache(max_size=settings.get_int("cache-size") * 1024 * 1024)
+            retry = RetryScheduler(deadline=settings.get_double("retry-deadline"))
+            limiter = RateLimiter(
+                requests_per_minute=settings.get_int("rate-limit-rpm"),
+                concurrency=settings.get_int("rate-limit-concurrency"),
+            )
+            postprocess = PostProcessor(PostProcessOptions.from_settings(settings))
+        self.generator = Generator(
+            cache=cache, retry=retry, limiter=limiter, ledger=UsageLedger(), index=PromptIndex(),
+            postprocess=postprocess,
+        )
+        self.engine = JobEngine(max_workers=max(1, args.jobs))
+
+    def provider(self, key):
+        if key == AUTO:  # the app's router keeps no history between runs
+            enabled = self.settings.get_strv("enabled-providers") if self.settings else []
+            known = {info.key for info in PROVIDERS.infos()}
+            key = next((key for key in sorted(enabled) if key in known), "stablediffusion")
+        try:
+            return PROVIDERS.instance(key, on_create=self.load_provider)
+        except KeyError:
+            raise SystemExit(f"Unknown provider {key!r}, see --list-providers")
+
+    def load_provider(self, provider):
+        try:
+            provider.load(data=json.loads(self.providers_data[provider.slug]))
+        except KeyError:  # provider not in data
+            pass
+        if self.args.api_key:
+            provider.load(data={"api_key": self.args.api_key})
+
+    def submit(self, item, default_provider):
+        provider = self.provider(item.get("provider", default_provider))
+        prompt = item["prompt"]
+        negative_prompt = item.get("negative_prompt", self.args.negative_prompt)
+        count = int(item.get("count", self.args.count))
+        base = output_base(self.args.output, prompt)
+        extension = self.generator.postprocess.options.extension if self.generator.postprocess else "png"
+
+        jobs = []
+        outputs = [(i, provider.path(base, i if count > 1 else None, extension)) for i in range(1, count + 1)]
+        for start in range(0, count, provider.max_batch):
+            chunk = outputs[start : start + provider.max_batch]
+            job = self.engine.submit(
+                self.generator.generate_batch,
+                provider,
+                prompt,
+                negative_prompt,
+                chunk,
+                force=self.args.force,
+                on_wait=self.on_wait,
+            )
+            job.entry = {
+                "prompt": prompt,
+                "negative_prompt": negative_prompt,
+                "provider": provider.slug,
+                "model": provider.model,
+                "variants": [variant for variant, _ in chunk],
+            }
+            jobs.append(job)
+        return jobs
+
+    def on_wait(self, error, seconds):
+        if error is None:
+            print(f"Rate limited, starting in {seconds:.0f} seconds", file=sys.stderr)
+        else:
+            print(f"{error}, retrying in {seconds:.0f} seconds", file=sys.stderr)
+
+    def manifest(self, job):
+        entry = dict(job.entry)
+        variants = entry.pop("variants")
+        if job.state == JobState.DONE:
+            for variant, result in zip(variants, job.result):
+                yield dict(
+                    entry,
+                    variant=variant,
+                    path=result.path if result else None,
+                    status="done" if result else "failed",
+                    elapsed=round(job.elapsed, 3),
+                )
+        else:
+            for variant in variants:
+                yield dict(
+                    entry,
+                    variant=variant,
+                    path=None,
+                    status=job.state.name.lower(),
+                    error=str(job.error) if job.error else None,
+                    elapsed=round(job.elapsed, 3),
+                )
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.list_providers:
+        for info in PROVIDERS.infos():
+            print(f"{info.key}\t{info.name}")
+        return 0
+
+    settings = load_settings()
+    default_provider = args.provider
+    if default_provider is None:
+        default_provider = settings.get_string("latest-provider") if settings else "stablediffusion"
+
+    os.makedirs(args.output, exist_ok=True)
+    runner = Runner(args, settings)
+    start = time.monotonic()
+    jobs = []
+    for item in read_prompts(args):
+        jobs.extend(runner.submit(item, default_provider))
+    if not jobs:
+        print("Nothing to generate, pass prompts or --file", file=sys.stderr)
+        return 2
+
+    failed = 0
+    wait([job.future for job in jobs])
+
+    manifest = os.path.join(args.output, "manifest.jsonl")
+    with open(manifest, "a") as f:
+        for job in jobs:
+            for entry in runner.manifest(job):
+                f.write(json.dumps(entry) + "\n")
+                if entry["path"]:
+                    print(entry["path"])
+                else:
+                    failed += 1
+                    print(f"{entry['provider']}: {entry['prompt']!r} {entry['status']}", file=sys.stderr)
+
+    runner.engine.shutdown()
+    if runner.generator.postprocess is not None:
+        runner.generator.postprocess.shutdown()
+    print(f"{len(jobs)} requests in {time.monotonic() - start:.1f} s, manifest in {manifest}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def parse_search_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="imaginer search",
+        description="Search the prompts of past generations.",
+    )
+    parser.add_argument("query", nargs="+", help="words to look for in the prompts")
+    parser.add_argument("-l", "--limit", type=int, default=20, help="maximum number of results")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per result")
+    return parser.parse_args(argv)
+
+
+def search(argv):
+    args = parse_search_args(argv)
+    generations = PromptIndex().search(" ".join(args.query), args.limit)
+    for generation in generations:
+        if args.json:
+            print(json.dumps(generation.as_dict()))
+        else:
+            print(f"{generation.path}\t{generation.provider}\t{generation.prompt}")
+    return 0 if generations else 1
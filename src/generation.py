@@ -0,0 +1,200 @@
+# generation.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+import re
+import time
+import unicodedata
+from time import gmtime, strftime
+
+from .provider.metrics import metrics
+from .provider.output import save_bytes
+from .provider.retry import RetryScheduler
+from .singleflight import SingleFlight
+
+
+def slugify(value):
+    value = (
+        unicodedata.normalize("NFKD", value)
+        .encode("ascii", "ignore")
+        .decode("ascii")
+    )
+    value = re.sub(r"[^\w\s-]", "", value).strip().lower()
+    return re.sub(r"[-\s]+", "-", value)
+
+
+def output_base(directory, prompt):
+    """Return the path, without provider and extension, of a new output."""
+    return f"{directory}/imaginer-{slugify(prompt)}-{strftime('%d-%b-%Y-%H-%M-%S', gmtime())}"
+
+
+class Generator:
+    """Turns a prompt into image files on disk.
+
+    This runs on job engine threads and never touches widgets, so the
+    same instance serves every window. Results are looked up in, and
+    stored to, the optional result cache; `force` skips the lookup.
+    Identical requests that are already in flight, from any window, are
+    joined instead of being sent again, and cold models, rate limits and
+    server errors are retried by the retry scheduler. Every request waits
+    for its turn in the optional rate limiter and is counted in the
+    optional usage ledger, and every image written goes through the
+    optional post-processor and is added to the optional prompt index.
+    """
+
+    def __init__(self, cache=None, retry=None, limiter=None, ledger=None, index=None, postprocess=None):
+        self.cache = cache
+        self.retry = retry or RetryScheduler()
+        self.limiter = limiter
+        self.ledger = ledger
+        self.index = index
+        self.postprocess = postprocess
+        self.flights = SingleFlight()
+
+    def _key(self, provider, prompt, negative_prompt, variant):
+        params = dict(provider.params(), variant=variant)
+        return self.cache.key(provider, prompt, negative_prompt, params)
+
+    def generate(self, provider, prompt, negative_prompt, path, variant=1, force=False, token=None, on_wait=None):
+        """Generate one image into `path` and return its `ImageResult`, or None."""
+        return self.generate_batch(
+            provider, prompt, negative_prompt, [(variant, path)],
+            force=force, token=token, on_wait=on_wait,
+        )[0]
+
+    def generate_batch(self, provider, prompt, negative_prompt, outputs, force=False, token=None, on_wait=None, on_progress=None):
+        """Generate an image for each `(variant, path)` of `outputs`.
+
+        Providers with `max_batch` greater than one get a single request
+        for every output that is not cached. Returns the list of
+        `ImageResult`, None where the provider returned nothing.
+        `on_wait(error, seconds)` is called before waiting for a retry, and
+        `on_progress` is handed to the provider to follow the downloads.
+        """
+        start = time.monotonic()
+        results = [None] * len(outputs)
+        keys = [None] * len(outputs)
+        missing = []
+        for i, (variant, path) in enumerate(outputs):
+            if self.cache is not None:
+                keys[i] = self._key(provider, prompt, negative_prompt, variant)
+                data = None if force else self._cache_get(keys[i])
+                if data is not None:
+                    results[i] = save_bytes(data, path)
+                    continue
+            missing.append(i)
+
+        if not missing:
+            results = self._postprocess(provider, prompt, negative_prompt, results)
+            self._record(provider, prompt, negative_prompt, results, start)
+            return results
+
+        flight = (
+            provider.slug,
+            provider.model,
+            prompt,
+            negative_prompt or "",
+            json.dumps(provider.params(), sort_keys=True),
+            tuple(outputs[i][0] for i in missing),
+        )
+        paths = [outputs[i][1] for i in missing]
+        fetched = self.flights.do(
+            flight,
+            lambda shared: self.retry.call(
+                lambda: self._fetch(provider, prompt, negative_prompt, paths, shared, on_wait, on_progress),
+                shared,
+                on_wait,
+            ),
+            token,
+        )
+
+        for i, result in zip(missing, fetched):
+            if result is None:
+                continue
+            path = outputs[i][1]
+            if os.path.splitext(result.path)[0] != os.path.splitext(path)[0]:
+                result = save_bytes(result.data, path)  # joined another caller's request
+            elif keys[i] is not None:
+                self._cache_put(keys[i], result.data)
+            results[i] = result
+        results = self._postprocess(provider, prompt, negative_prompt, results)
+        metrics.observe(provider.slug, "total", time.monotonic() - start)
+        self._record(provider, prompt, negative_prompt, results, start)
+        return results
+
+    # the cache only saves requests, a broken one must not fail a generation
+    def _cache_get(self, key):
+        try:
+            return self.cache.get(key)
+        except OSError as e:
+            print(f"Could not read the result cache: {e}")
+            return None
+
+    def _cache_put(self, key, data):
+        try:
+            self.cache.put(key, data)
+        except OSError as e:
+            print(f"Could not write to the result cache: {e}")
+
+    def _postprocess(self, provider, prompt, negative_prompt, results):
+        # the cache keeps the images as they were sent, so that changing
+        # the post-processing options applies to cached results too
+        if self.postprocess is None:
+            return results
+        return [self.postprocess.run(provider, prompt, negative_prompt, result) for result in results]
+
+    def _record(self, provider, prompt, negative_prompt, results, start):
+        if self.index is None:
+            return
+        latency = time.monotonic() - start
+        for result in results:
+            if result is not None:
+                self.index.add(provider, prompt, negative_prompt, result, latency)
+
+    def _fetch(self, provider, prompt, negative_prompt, paths, token, on_wait=None, on_progress=None):
+        if self.limiter is None:
+            return self._ask(provider, prompt, negative_prompt, paths, token, on_progress=on_progress)
+        queued = time.monotonic()
+        return self.limiter.call(
+            provider,
+            lambda: self._ask(provider, prompt, negative_prompt, paths, token, queued, on_progress),
+            token,
+            on_wait,
+        )
+
+    def _ask(self, provider, prompt, negative_prompt, paths, token, queued=None, on_progress=None):
+        if queued is not None:
+            metrics.observe(provider.slug, "wait", time.monotonic() - queued)
+        # only passed when wanted, so providers without it keep working
+        options = {"on_progress": on_progress} if on_progress is not None else {}
+        results = []
+        try:
+            if len(paths) > 1:
+                results = provider.ask_batch(prompt, negative_prompt, paths, token=token, **options) or []
+            else:
+                results = [provider.ask(prompt, negative_prompt, paths[0], token=token, **options)]
+        except Exception as e:
+            if token is None or not token.cancelled:
+                metrics.error(provider.slug, e)
+            raise
+        finally:
+            if self.ledger is not None:
+                self.ledger.record(provider, images=sum(1 for r in results if r is not None))
+        return (results + [None] * len(paths))[: len(paths)]
@@ -0,0 +1,193 @@
+# history.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+from collections import OrderedDict
+
+from gi.repository import Gdk, Gio, GLib, GObject, Gtk
+
+from .jobs import JobEngine, JobState
+from .thumbnails import ThumbnailCache
+
+
+class HistoryItem(GObject.Object):
+    __gtype_name__ = "HistoryItem"
+
+    path = GObject.Property(type=str)
+    prompt = GObject.Property(type=str)
+    provider = GObject.Property(type=str)
+
+    def __init__(self, path, prompt, provider):
+        super().__init__(path=path, prompt=prompt, provider=provider)
+
+
+class HistoryModel(GObject.Object, Gio.ListModel):
+    """The images of the finished jobs, read from the job queue a page at a time.
+
+    Only the number of images is counted up front. The grid asks for the
+    items it shows, and each miss reads one page of `page_size` rows;
+    the `max_pages` most recently used pages are kept. The rows are those
+    finished when the model was made, so their positions never move, and
+    images added later are kept in a list in front of them.
+    """
+
+    __gtype_name__ = "HistoryModel"
+
+    def __init__(self, queue, page_size=100, max_pages=8):
+        super().__init__()
+        self.queue = queue
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.added = []
+        self.last_id, self.count = queue.history_snapshot()
+
+    def do_get_item_type(self):
+        return HistoryItem
+
+    def do_get_n_items(self):
+        return len(self.added) + self.count
+
+    def do_get_item(self, position):
+        if position < len(self.added):
+            return self.added[position]
+        page, offset = divmod(position - len(self.added), self.page_size)
+        items = self.pages.get(page)
+        if items is None:
+            items = self.pages[page] = [
+                HistoryItem(path, prompt, provider)
+                for path, prompt, provider in self.queue.history_page(
+                    self.last_id, page * self.page_size, self.page_size
+                )
+            ]
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        else:
+            self.pages.move_to_end(page)
+        return items[offset] if offset < len(items) else None
+
+    def prepend(self, item):
+        self.added.insert(0, item)
+        self.items_changed(0, 0, 1)
+
+
+class History:
+    """Every image generated so far, as a list model shared by all windows.
+
+    The model pages its rows from the job queue once it is first needed,
+    and `search()` builds a separate model from the prompt index.
+    Thumbnails are decoded by a small engine of their own, so scrolling
+    never delays a generation, and only the most recent `max_textures`
+    are kept in memory: the grid recycles its cells, and an image that
+    scrolls back into view is read again from the thumbnail cache.
+    """
+
+    def __init__(self, queue, index=None, thumbnails=None, max_textures=512):
+        self.queue = queue
+        self.index = index
+        self.thumbnails = thumbnails or ThumbnailCache()
+        self.store = None
+        self.max_textures = max_textures
+        self.textures = OrderedDict()
+        self.engine = JobEngine(max_workers=2, dispatch=GLib.idle_add)
+
+    def load(self):
+        if self.store is None:
+            self.store = HistoryModel(self.queue)
+
+    def add(self, result, prompt, provider):
+        """Put a new image at the top of the history, if it was loaded."""
+        if self.store is not None:
+            self.store.prepend(HistoryItem(result.path, prompt, provider))
+
+    def search(self, text, limit=500):
+        """Return a list model of the images whose prompts match `text`."""
+        store = Gio.ListStore(item_type=HistoryItem)
+        if self.index is not None:
+            store.splice(0, 0, [
+                HistoryItem(generation.path, generation.prompt, generation.provider)
+                for generation in self.index.search(text, limit)
+            ])
+        return store
+
+    def texture(self, path):
+        texture = self.textures.get(path)
+        if texture is not None:
+            self.textures.move_to_end(path)
+        return texture
+
+    def request(self, path, callback):
+        """Load the thumbnail of `path` off-thread and pass its texture to `callback`.
+
+        Returns the job, so that a cell scrolled out of view can cancel it.
+        """
+        def on_state(job, state):
+            if state == JobState.DONE:
+                texture = Gdk.Texture.new_from_bytes(GLib.Bytes.new(job.result))
+                self.textures[path] = texture
+                while len(self.textures) > self.max_textures:
+                    self.textures.popitem(last=False)
+                callback(texture)
+            elif state == JobState.FAILED:
+                print("Could not load thumbnail", path, job.error)
+
+        return self.engine.submit(
+            lambda token: self.thumbnails.get(path), on_state=on_state
+        )
+
+    def shutdown(self):
+        self.engine.shutdown()
+
+
+class HistoryFactory(Gtk.SignalListItemFactory):
+    """Builds and recycles the cells of the history grid."""
+
+    def __init__(self, history):
+        super().__init__()
+        self.history = history
+        self.connect("setup", self.on_setup)
+        self.connect("bind", self.on_bind)
+        self.connect("unbind", self.on_unbind)
+
+    def on_setup(self, factory, list_item):
+        picture = Gtk.Picture()
+        picture.set_size_request(128, 128)
+        picture.set_content_fit(Gtk.ContentFit.COVER)
+        picture.add_css_class("card")
+        picture.job = None
+        list_item.set_child(picture)
+
+    def on_bind(self, factory, list_item):
+        picture = list_item.get_child()
+        item = list_item.get_item()
+        picture.set_tooltip_text(f"{item.prompt}\n{os.path.basename(item.path)}")
+        texture = self.history.texture(item.path)
+        picture.set_paintable(texture)
+        if texture is None:
+            def on_texture(texture):
+                if list_item.get_item() is item:  # still showing the same image
+                    picture.set_paintable(texture)
+            picture.job = self.history.request(item.path, on_texture)
+
+    def on_unbind(self, factory, list_item):
+        picture = list_item.get_child()
+        if picture.job is not None and not picture.job.done:
+            picture.job.cancel()
+        picture.job = None
+        picture.set_paintable(None)
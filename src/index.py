@@ -0,0 +1,147 @@
+# index.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from .xdg import data_dir
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    prompt TEXT NOT NULL,
+    negative_prompt TEXT NOT NULL DEFAULT '',
+    provider TEXT NOT NULL,
+    model TEXT,
+    latency REAL,
+    path TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS generations_hash ON generations (hash);
+CREATE INDEX IF NOT EXISTS generations_path ON generations (path);
+CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5 (
+    prompt, negative_prompt, content='generations', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS generations_insert AFTER INSERT ON generations BEGIN
+    INSERT INTO generations_fts (rowid, prompt, negative_prompt)
+    VALUES (new.id, new.prompt, new.negative_prompt);
+END;
+CREATE TRIGGER IF NOT EXISTS generations_delete AFTER DELETE ON generations BEGIN
+    INSERT INTO generations_fts (generations_fts, rowid, prompt, negative_prompt)
+    VALUES ('delete', old.id, old.prompt, old.negative_prompt);
+END;
+"""
+
+
+class Generation:
+    """A row of the prompt index."""
+
+    def __init__(self, row):
+        self.id = row["id"]
+        self.prompt = row["prompt"]
+        self.negative_prompt = row["negative_prompt"]
+        self.provider = row["provider"]
+        self.model = row["model"]
+        self.latency = row["latency"]
+        self.path = row["path"]
+        self.hash = row["hash"]
+        self.created = row["created"]
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def match_query(text):
+    """Turn free text into an FTS5 query matching every word as a prefix.
+
+    Each word is quoted, so that punctuation in prompts is never read as
+    query syntax.
+    """
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+class PromptIndex:
+    """Full-text index of every image generated, by its prompts.
+
+    Rows are added as each image is written, by the generator, so the
+    index is always up to date without ever scanning the output
+    directory. Searches go through an external content FTS5 table kept
+    in sync by triggers, and are ranked by relevance.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(data_dir(), "index.sqlite3")
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def add(self, provider, prompt, negative_prompt, result, latency=None):
+        """Record the `ImageResult` generated by `provider` for a prompt."""
+        with self._lock:
+            if self.db is None:
+                return
+            self.db.execute(
+                "INSERT INTO generations"
+                " (prompt, negative_prompt, provider, model, latency, path, hash, created)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    prompt,
+                    negative_prompt or "",
+                    provider.slug,
+                    provider.model,
+                    latency,
+                    result.path,
+                    hashlib.sha256(result.data).hexdigest(),
+                    time.time(),
+                ),
+            )
+
+    def remove(self, path):
+        """Forget the generations written to `path`."""
+        with self._lock:
+            if self.db is None:
+                return
+            self.db.execute("DELETE FROM generations WHERE path = ?", (path,))
+
+    def search(self, text, limit=100):
+        """Return the generations whose prompts match `text`, best first."""
+        query = match_query(text)
+        if not query:
+            return []
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT generations.* FROM generations_fts"
+                " JOIN generations ON generations.id = generations_fts.rowid"
+                " WHERE generations_fts MATCH ? ORDER BY rank LIMIT ?",
+                (query, limit),
+            ).fetchall()
+        return [Generation(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+            self.db = None
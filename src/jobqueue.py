@@ -0,0 +1,201 @@
+# jobqueue.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .provider.output import load_output
+from .xdg import data_dir
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    provider TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    negative_prompt TEXT NOT NULL DEFAULT '',
+    outputs TEXT NOT NULL,
+    force INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    results TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+
+class QueuedJob:
+    """A row of the job queue."""
+
+    def __init__(self, row):
+        self.id = row["id"]
+        self.provider = row["provider"]
+        self.prompt = row["prompt"]
+        self.negative_prompt = row["negative_prompt"]
+        self.outputs = [tuple(output) for output in json.loads(row["outputs"])]
+        self.force = bool(row["force"])
+        self.status = row["status"]
+        self.results = json.loads(row["results"] or "[]")
+        self.error = row["error"]
+        self.created = row["created"]
+
+
+class JobQueue:
+    """Durable record of the generations that were asked for.
+
+    Every call is written to an SQLite database under $XDG_DATA_HOME
+    before it is submitted to the job engine, with the output paths it
+    will write to. Jobs still pending or running when the application
+    quits are handed back by `unfinished()` on the next launch, and since
+    the paths are fixed up front, running a job again reuses the images
+    that were already written instead of creating new files. Finished
+    jobs are kept as the generation history; only failed and cancelled
+    ones are dropped after `keep_days`.
+    """
+
+    def __init__(self, path=None, keep_days=30):
+        self.path = path or os.path.join(data_dir(), "jobs.sqlite3")
+        self.keep_days = keep_days
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.prune()
+
+    def _execute(self, query, args=()):
+        with self._lock:
+            if self.db is None:  # closed on quit, while jobs were winding down
+                return []
+            return self.db.execute(query, args).fetchall()
+
+    def add(self, provider, prompt, negative_prompt, outputs, force=False):
+        """Record a call and return its id."""
+        now = time.time()
+        with self._lock:
+            cursor = self.db.execute(
+                "INSERT INTO jobs (provider, prompt, negative_prompt, outputs, force, created, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (provider.slug, prompt, negative_prompt or "", json.dumps(outputs), int(force), now, now),
+            )
+            return cursor.lastrowid
+
+    def set_status(self, job_id, status, results=None, error=None):
+        self._execute(
+            "UPDATE jobs SET status = ?, results = ?, error = ?, updated = ? WHERE id = ?",
+            (status, json.dumps(results) if results is not None else None, error, time.time(), job_id),
+        )
+
+    def delete(self, job_id):
+        self._execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def get(self, job_id):
+        rows = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return QueuedJob(rows[0]) if rows else None
+
+    def unfinished(self):
+        """Return the jobs that were pending or running, oldest first."""
+        rows = self._execute(
+            "SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY id", (PENDING, RUNNING)
+        )
+        return [QueuedJob(row) for row in rows]
+
+    def history_snapshot(self):
+        """Return the id of the newest finished job and the number of images of all finished jobs."""
+        rows = self._execute(
+            "SELECT max(jobs.id), count(*) FROM jobs, json_each(jobs.results)"
+            " WHERE status = ? AND json_each.value IS NOT NULL",
+            (DONE,),
+        )
+        return (rows[0][0] or 0, rows[0][1]) if rows else (0, 0)
+
+    def history_page(self, last_id, offset, limit):
+        """Return `(path, prompt, provider)` of images of the jobs finished up to `last_id`, newest first."""
+        rows = self._execute(
+            "SELECT json_each.value, prompt, provider FROM jobs, json_each(jobs.results)"
+            " WHERE status = ? AND jobs.id <= ? AND json_each.value IS NOT NULL"
+            " ORDER BY jobs.id DESC, json_each.key LIMIT ? OFFSET ?",
+            (DONE, last_id, limit, offset),
+        )
+        return [tuple(row) for row in rows]
+
+    def prune(self):
+        self._execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?",
+            (FAILED, CANCELLED, time.time() - self.keep_days * 86400),
+        )
+
+    def run(self, generator, job_id, provider, prompt, negative_prompt, outputs, force=False, token=None, on_wait=None, on_progress=None):
+        """Run a recorded call through `generator` and record its outcome.
+
+        Outputs that were already written by an earlier, interrupted run
+        are returned as they are. A job cancelled because the application
+        is shutting down goes back to pending so that it is resumed.
+        """
+        self.set_status(job_id, RUNNING)
+        results = [load_output(path) for _, path in outputs]
+        missing = [i for i, result in enumerate(results) if result is None]
+        try:
+            if missing:
+                fetched = generator.generate_batch(
+                    provider, prompt, negative_prompt,
+                    [outputs[i] for i in missing],
+                    force=force, token=token, on_wait=on_wait, on_progress=on_progress,
+                )
+                for i, result in zip(missing, fetched):
+                    results[i] = result
+        except Exception as e:
+            if token is not None and token.cancelled:
+                self._interrupted(job_id, token.reason)
+            else:
+                self.set_status(job_id, FAILED, error=str(e))
+            raise
+        self.set_status(job_id, DONE, results=[result and result.path for result in results])
+        return results
+
+    def _interrupted(self, job_id, reason):
+        if reason == "shutdown":
+            self.set_status(job_id, PENDING)
+        elif reason == "deadline":
+            self.set_status(job_id, FAILED, error="Generation took too long")
+        else:
+            self.set_status(job_id, CANCELLED)
+
+    def cancel(self, job_ids):
+        """Mark jobs stopped by the user, so they are not resumed."""
+        for job_id in job_ids:
+            self._execute(
+                "UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND status IN (?, ?)",
+                (CANCELLED, time.time(), job_id, PENDING, RUNNING),
+            )
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,239 @@
+# jobs.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum, auto
+
+from .provider.cancel import CancelToken, Cancelled
+
+
+class JobState(IntEnum):
+    PENDING = auto()
+    RUNNING = auto()
+    DONE = auto()
+    FAILED = auto()
+    CANCELLED = auto()
+
+
+class Job:
+    """A unit of work running on the engine's thread pool.
+
+    The target is called with a `token` keyword argument that it must pass
+    down to the transport so that cancelling the job aborts its request.
+    """
+
+    def __init__(self, target, args, kwargs, deadline=None, on_state=None, on_finish=None):
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.deadline = deadline
+        self.on_state = on_state
+        self.token = CancelToken()
+        self.state = JobState.PENDING
+        self.result = None
+        self.error = None
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self.on_finish = on_finish
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.state >= JobState.DONE
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.monotonic()) - self.started
+
+    def cancel(self, reason="cancelled"):
+        """Cancel the job without waiting for its thread to return."""
+        self.token.cancel(reason)
+        if self.future is not None:
+            self.future.cancel()
+
+
+class JobEngine:
+    """Runs jobs on a thread pool and reports their state changes.
+
+    State callbacks are passed through `dispatch`, so the application can
+    hand them to `GLib.idle_add` and never touch widgets from a worker.
+    """
+
+    def __init__(self, max_workers=4, dispatch=None, deadline=None):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="imaginer-job"
+        )
+        self.dispatch = dispatch or (lambda callback, *args: callback(*args))
+        self.deadline = deadline
+        self.jobs = set()
+        self._lock = threading.Lock()
+
+    def submit(self, target, *args, deadline=None, on_state=None, on_finish=None, **kwargs):
+        """Queue `target` and return its Job.
+
+        `on_state(job, state)` is dispatched to the main loop on every
+        state change, with the state entered: the job may have moved on
+        by the time it runs. `on_finish` runs on the worker thread once
+        the job is final.
+        """
+        job = Job(target, args, kwargs, deadline or self.deadline, on_state, on_finish)
+        job.token.add_callback(lambda: self._on_cancel(job))
+        if job.deadline:
+            job._timer = threading.Timer(job.deadline, job.token.cancel, ("deadline",))
+            job._timer.daemon = True
+            job._timer.start()
+        with self._lock:
+            self.jobs.add(job)
+        job.future = self.executor.submit(self._run, job)
+        return job
+
+    def _set_state(self, job, state, result=None, error=None):
+        with job._lock:
+            if job.done:  # first final state wins, late results are dropped
+                return False
+            job.state = state
+            if state == JobState.RUNNING:
+                job.started = time.monotonic()
+            else:
+                job.result = result
+                job.error = error
+                job.finished = time.monotonic()
+        if job.done:
+            if job._timer is not None:
+                job._timer.cancel()
+            with self._lock:
+                self.jobs.discard(job)
+        if job.on_state is not None:
+            self.dispatch(job.on_state, job, state)
+        if job.done and job.on_finish is not None:
+            job.on_finish(job)
+        return True
+
+    def _on_cancel(self, job):
+        if job.token.reason == "deadline":
+            self._set_state(job, JobState.FAILED, error=TimeoutError(
+                f"Generation took longer than {job.deadline:g} seconds"
+            ))
+        else:
+            self._set_state(job, JobState.CANCELLED)
+
+    def _run(self, job):
+        if job.token.cancelled or not self._set_state(job, JobState.RUNNING):
+            return
+        try:
+            result = job.target(*job.args, token=job.token, **job.kwargs)
+        except Cancelled:
+            self._on_cancel(job)
+        except Exception as e:
+            if job.token.cancelled:
+                self._on_cancel(job)
+            else:
+                self._set_state(job, JobState.FAILED, error=e)
+        else:
+            self._set_state(job, JobState.DONE, result=result)
+
+    def cancel_all(self, reason="cancelled"):
+        with self._lock:
+            jobs = list(self.jobs)
+        for job in jobs:
+            job.cancel(reason)
+
+    def shutdown(self):
+        self.cancel_all("shutdown")
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class JobGroup:
+    """Jobs submitted together that are stopped together."""
+
+    def __init__(self, jobs=None):
+        self.jobs = list(jobs or [])
+
+    @property
+    def done(self):
+        return all(job.done for job in self.jobs)
+
+    def add(self, job):
+        self.jobs.append(job)
+        return job
+
+    def cancel(self):
+        for job in list(self.jobs):
+            job.cancel()
+
+
+class Batch:
+    """Runs the same target over several calls with bounded parallelism.
+
+    At most `parallelism` jobs are submitted at once; the next call is
+    queued as soon as one finishes, without going through the main loop.
+    """
+
+    def __init__(self, engine, target, calls, parallelism=2, on_state=None):
+        self.engine = engine
+        self.target = target
+        self.pending = list(calls)
+        self.total = len(self.pending)
+        self.parallelism = max(1, parallelism)
+        self.on_state = on_state
+        self.jobs = []
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return sum(1 for job in self.jobs if job.done)
+
+    @property
+    def done(self):
+        return not self.pending and all(job.done for job in self.jobs)
+
+    def start(self):
+        for _ in range(self.parallelism):
+            self._next()
+        return self
+
+    def _next(self, *args):
+        with self._lock:
+            if self.cancelled or not self.pending:
+                return
+            call_args, call_kwargs = self.pending.pop(0)
+            job = self.engine.submit(
+                self.target,
+                *call_args,
+                on_state=self.on_state,
+                on_finish=self._next,
+                **call_kwargs,
+            )
+            self.jobs.append(job)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            self.pending.clear()
+            jobs = list(self.jobs)
+        for job in jobs:
+            job.cancel()
@@ -20,14 +20,12 @@
 import sys
 import gi
 import sys
-import threading
 import json
 
 gi.require_version("Gtk", "4.0")
 gi.require_version("Adw", "1")
 gi.require_version("Gdk", "4.0")
-gi.require_version("Gst", "1.0")
-gi.require_version('WebKit', '6.0')
+gi.require_version("GdkPixbuf", "2.0")
 
 from gi.repository import Gtk, Gio, Adw, Gdk, GLib
 from .window import ImaginerWindow
@@ -39,49 +37,29 @@ from .constants import app_id, version, build_type
 
 from tempfile import NamedTemporaryFile
 
-import unicodedata
-from time import gmtime, strftime
 from os.path import basename, splitext
 
-from .provider import PROVIDERS
+from .provider import PROVIDERS, ProviderInstances
+from .provider.transport import transport
+from .jobs import Batch, JobEngine, JobGroup, JobState
+from .jobqueue import FAILED, JobQueue
+from .postprocess import PostProcessOptions, PostProcessor
+from .progress import TransferProgress
+from .routing import AUTO, Router
+from .history import History
+from .index import PromptIndex
+from .cache import ResultCache
+from .generation import Generator, output_base
+from .provider.errors import ModelLoadingError
+from .provider.metrics import metrics
+from .provider.ratelimit import RateLimiter
+from .provider.retry import RetryScheduler
+from .usage import UsageLedger
+from .warmup import Warmup, LOADING, WARM
+from .watchdog import Watchdog
 import platform
 import os
 import tempfile
-import re
-
-class KillableThread(threading.Thread):
-    def __init__(self, *args, **keywords):
-        threading.Thread.__init__(self, *args, **keywords)
-        self.killed = False
-    
-    def start(self):
-        self.__run_backup = self.run
-        self.run = self.__run     
-        threading.Thread.start(self)
-    
-    def __run(self):
-        sys.settrace(self.globaltrace)
-        self.__run_backup()
-        self.run = self.__run_backup
-    
-    def globaltrace(self, frame, event, arg):
-        if event == 'call':
-            return self.localtrace
-        else:
-            return None
-    
-    def localtrace(self, frame, event, arg):
-        if self.killed:
-            if event == 'line':
-                raise SystemExit()
-        return self.localtrace
-    
-    def kill(self):
-        self.killed = True
-
- 
-
-
 
 class ImaginerApplication(Adw.Application):
     """The main application singleton class."""
@@ -97,6 +75,9 @@ class ImaginerApplication(Adw.Application):
             "preferences", self.on_preferences_action, ["<primary>comma"]
         )
         self.create_action("ask", self.on_ask_action, ["<primary>Return"])
+        self.create_action(
+            "regenerate", self.on_regenerate_action, ["<primary><shift>Return"]
+        )
         self.create_action("stop", self.on_stop_action, ["<primary>Escape"])
         self.create_action("choose_output", self.on_file_chooser, ["<primary>s"])
         self.create_action("new", self.on_new_window, ["<primary>n"])
@@ -111,6 +92,59 @@ class ImaginerApplication(Adw.Application):
         )
         self.latest_provider = self.settings.get_string("latest-provider")
 
+        transport.configure(
+            pool_size=self.settings.get_int("http-pool-size"),
+            connect_timeout=self.settings.get_double("http-connect-timeout"),
+            read_timeout=self.settings.get_double("http-read-timeout"),
+            http2=self.settings.get_boolean("http2"),
+        )
+        self.jobs = JobEngine(
+            max_workers=self.settings.get_int("jobs-max-workers"),
+            dispatch=GLib.idle_add,
+            deadline=self.settings.get_double("job-deadline"),
+        )
+        self.cache = None
+        if self.settings.get_boolean("cache-enabled"):
+            self.cache = ResultCache(max_size=self.settings.get_int("cache-size") * 1024 * 1024)
+        self.warmup_source = None
+        self.ledger = UsageLedger()
+        self.queue = JobQueue()
+        self.index = PromptIndex()
+        self.history = History(self.queue, self.index)
+        self.resumed = False
+        self.metrics_source = None
+        self.metrics_server = None
+        self.start_metrics()
+
+        self.watchdog = None
+        threshold = self.settings.get_int("watchdog-threshold")
+        if threshold > 0:
+            self.watchdog = Watchdog(threshold / 1000).start()
+        self.generator = Generator(
+            cache=self.cache,
+            retry=RetryScheduler(deadline=self.settings.get_double("retry-deadline")),
+            limiter=RateLimiter(
+                requests_per_minute=self.settings.get_int("rate-limit-rpm"),
+                concurrency=self.settings.get_int("rate-limit-concurrency"),
+            ),
+            ledger=self.ledger,
+            index=self.index,
+            postprocess=PostProcessor(PostProcessOptions.from_settings(self.settings)),
+        )
+        self.settings.connect("changed", self.on_settings_changed)
+        self.warmup = Warmup(
+            self.jobs, on_change=self.on_warmup_changed, limiter=self.generator.limiter, ledger=self.ledger
+        )
+        # attempts get an engine of their own, the batch jobs of the
+        # automatic choice wait for them on `self.jobs`
+        self.router = Router(
+            JobEngine(
+                max_workers=self.settings.get_int("jobs-max-workers"),
+                deadline=self.settings.get_double("job-deadline"),
+            ),
+            hedge=self.settings.get_boolean("routing-hedge"),
+        )
+
         self.create_stateful_action(
             "set_provider",
             GLib.VariantType.new("s"),
@@ -119,6 +153,12 @@ class ImaginerApplication(Adw.Application):
         )
 
 
+    def on_settings_changed(self, settings, key):
+        if key.startswith(("postprocess-", "output-")):
+            self.generator.postprocess.options = PostProcessOptions.from_settings(settings)
+        elif key == "routing-hedge":
+            self.router.hedge = settings.get_boolean(key)
+
     def quitting(self, *args, **kwargs):
         """Called before closing main window."""
         self.settings.set_strv("enabled-providers", list(self.enabled_providers))
@@ -127,21 +167,71 @@ class ImaginerApplication(Adw.Application):
         print("Saving providers data...")
 
         self.save_providers()
+        if len(self.get_windows()) <= 1:
+            if self.warmup_source:
+                GLib.source_remove(self.warmup_source)
+                self.warmup_source = None
+            self.warmup.cancel()
+            self.stop_metrics()
+            if self.watchdog:
+                self.watchdog.stop()
+            self.jobs.shutdown()
+            self.router.engine.shutdown()
+            self.generator.postprocess.shutdown()
+            self.history.shutdown()
+            self.queue.close()
+            self.index.close()
+            transport.close()
+        elif args and isinstance(args[0], ImaginerWindow):
+            args[0].stop()  # its results would have nowhere to go
         self.win.close()
 
+    def start_metrics(self):
+        """Export the metrics to the configured file and local port, if any."""
+        path = self.settings.get_string("metrics-file")
+        if path:
+            self.metrics_source = GLib.timeout_add_seconds(15, self.write_metrics, path)
+        port = self.settings.get_int("metrics-port")
+        if port:
+            try:
+                self.metrics_server = metrics.serve(port)
+            except OSError as e:
+                print("Could not serve metrics on port", port, e)
+
+    def write_metrics(self, path):
+        try:
+            metrics.write(path)
+        except OSError as e:
+            print("Could not write metrics to", path, e)
+        return GLib.SOURCE_CONTINUE
+
+    def stop_metrics(self):
+        if self.metrics_source:
+            GLib.source_remove(self.metrics_source)
+            self.metrics_source = None
+            self.write_metrics(self.settings.get_string("metrics-file"))
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server = None
+
     @property
     def win(self):
         return self.props.active_window
 
+    def hide_errors(self):
+        for window in self.get_windows():
+            if isinstance(window, ImaginerWindow):
+                window.hide_error()
+
     def on_quit(self, action, param):
         """Called when the user activates the Quit action."""
         self.quitting()
 
     def save_providers(self):
-        r = {}
-        for k, p in self.providers.items():
+        # providers that were never used keep their data untouched
+        r = dict(self.settings.get_value("providers-data").unpack())
+        for p in PROVIDERS.created():
             r[p.slug] = json.dumps(p.save())
-        print(r)
         data = GLib.Variant("a{ss}", r)
         self.settings.set_value("providers-data", data)
 
@@ -156,6 +246,9 @@ class ImaginerApplication(Adw.Application):
     def on_set_provider_action(self, action, *args):
         self.provider = args[0].get_string()
         print("Setting provider to", self.provider)
+        for window in self.get_windows():
+            if isinstance(window, ImaginerWindow):
+                self.update_provider_state(window)
 
         Gio.SimpleAction.set_state(self.lookup_action("set_provider"), args[0])
 
@@ -169,21 +262,112 @@ class ImaginerApplication(Adw.Application):
             win = ImaginerWindow(application=self)
         win.connect("close-request", self.quitting)
         self.load_dropdown(win)
-        self.load()
         win.file_chooser = Gtk.FileChooserNative()
         win.file_chooser.set_title(_("Choose a directory"))
         win.file_chooser.set_transient_for(win)
         win.file_chooser.set_action(Gtk.FileChooserAction.SELECT_FOLDER)
         win.file_chooser.set_modal(True)
-        win.file_chooser.connect("response", self.on_file_chooser_response)
+        win.file_chooser.connect("response", self.on_file_chooser_response, win)
 
-        for k, p in self.providers.items():
-            if p.slug == self.latest_provider:
-                print("Setting selected provider to", k)
-                self.provider = k
-                break
+        if self.latest_provider in self.providers or self.latest_provider == AUTO:
+            self.provider = self.latest_provider
+        self.update_provider_state(win)
         win.present()
 
+        if self.settings.get_boolean("wakeup-enabled") and self.warmup_source is None:
+            GLib.idle_add(lambda: self.on_warmup_timeout() and GLib.SOURCE_REMOVE)
+            self.warmup_source = GLib.timeout_add_seconds(
+                self.settings.get_int("wakeup-interval"), self.on_warmup_timeout
+            )
+
+        if not self.resumed:
+            self.resumed = True
+            self.resume_jobs(win)
+
+    def provider_by_slug(self, slug):
+        for info in PROVIDERS.infos():
+            if info.slug == slug:
+                return PROVIDERS.instance(info.key, self, self.load_provider)
+        return None
+
+    def resume_jobs(self, win):
+        """Finish the generations left unfinished by the previous session."""
+        calls = []
+        for queued in self.queue.unfinished():
+            provider = self.provider_by_slug(queued.provider)
+            if provider is None:
+                self.queue.set_status(queued.id, FAILED, error="Unknown provider")
+                continue
+            calls.append((
+                (self.generator, queued.id, provider, queued.prompt,
+                 queued.negative_prompt, queued.outputs),
+                {"force": queued.force},
+            ))
+        if not calls:
+            return
+
+        win.toast_overlay.add_toast(Adw.Toast.new(
+            _("Resuming {} unfinished generations").format(len(calls))
+        ))
+
+        def on_state(job, state):
+            if state == JobState.DONE:
+                provider, prompt = job.args[2], job.args[3]
+                for result in job.result:
+                    if result:
+                        win.add_result(result)
+                        self.history.add(result, prompt, provider.slug)
+            elif state == JobState.FAILED:
+                win.show_error(job.error)
+
+        batch = Batch(
+            self.jobs,
+            self.queue.run,
+            calls,
+            parallelism=self.settings.get_int("batch-parallelism"),
+            on_state=on_state,
+        )
+        win.track(batch.start(), [args[1] for args, _ in calls])
+
+    def on_warmup_timeout(self):
+        """Wake the models of the enabled providers up while nothing runs."""
+        if not self.jobs.jobs:
+            # only providers with models to wake up are imported
+            slugs = [slug for slug in self.providers if self.providers.info(slug).warm_up]
+            slugs.sort(key=lambda slug: slug != self.latest_provider)
+            providers = [self.providers[slug] for slug in slugs]
+            self.warmup.warm(providers)
+        return GLib.SOURCE_CONTINUE
+
+    def on_warmup_changed(self, slug, state):
+        for window in self.get_windows():
+            if isinstance(window, ImaginerWindow):
+                self.update_provider_state(window)
+
+    def update_provider_state(self, window):
+        if getattr(self, "provider", None) == AUTO:
+            infos = [self.providers.info(slug) for slug in self.providers]
+            best = self.router.rank(infos, self.loading_providers())
+            name = f"{_('Automatic')} · {best[0].name}" if best else _("Automatic")
+            window.set_provider_state(name)
+            return
+        try:
+            info = self.providers.info(self.provider)
+        except (AttributeError, KeyError):  # no provider selected
+            return
+        window.set_provider_state(info.name, self.warmup.state(info.slug))
+
+    def loading_providers(self):
+        """The slugs of the enabled providers whose model is loading."""
+        return {slug for slug in self.providers if self.warmup.state(slug) == LOADING}
+
+    def mark_provider(self, provider, job, state):
+        """Update the warm-up state of a provider from a finished generation."""
+        if state == JobState.DONE:
+            self.warmup.mark(provider.slug, WARM)
+        elif state == JobState.FAILED and isinstance(job.error, ModelLoadingError):
+            self.warmup.mark(provider.slug, LOADING)
+
     def load_dropdown(self, window=None):
         if window is None:
             window = self.win
@@ -193,35 +377,28 @@ class ImaginerApplication(Adw.Application):
         section_menu = Gio.Menu()
 
         provider_menu = Gio.Menu()
+        item_model = Gio.MenuItem()
+        item_model.set_label(_("Automatic"))
+        item_model.set_action_and_target_value("app.set_provider", GLib.Variant("s", AUTO))
+        provider_menu.append_item(item_model)
 
-
-        self.providers = {}
         self.providers_data = self.settings.get_value("providers-data")
-        print(self.providers_data)
-        print(self.enabled_providers)
+        self.providers = ProviderInstances(
+            PROVIDERS, self.enabled_providers, app=self, on_create=self.load_provider
+        )
 
-
-        for provider in self.enabled_providers:
-            print("Loading provider", provider)
-            try:
-                item = PROVIDERS[provider]
-                item_model = Gio.MenuItem()
-                item_model.set_label(item.name)
-                item_model.set_action_and_target_value(
-                    "app.set_provider",
-                    GLib.Variant("s", item.slug))
-                provider_menu.append_item(item_model)
-            except KeyError:
-                print("Provider", provider, "not found")
-                continue
-            else:
-                try:
-                    self.providers[item.slug]  # doesn't re load if already loaded
-                except KeyError:
-                    self.providers[item.slug] = PROVIDERS[provider](window, self)
+        for slug in self.providers:
+            item = self.providers.info(slug)
+            item_model = Gio.MenuItem()
+            item_model.set_label(item.name)
+            item_model.set_action_and_target_value(
+                "app.set_provider",
+                GLib.Variant("s", item.slug))
+            provider_menu.append_item(item_model)
 
         section_menu.append_submenu(_("Providers"), provider_menu)
 
+        section_menu.append_item(Gio.MenuItem.new(label=_("Force Regenerate"), detailed_action="app.regenerate"))
         section_menu.append_item(Gio.MenuItem.new(label=_("Preferences"), detailed_action="app.preferences"))
         section_menu.append_item(Gio.MenuItem.new(label=_("Keyboard Shortcuts"), detailed_action="win.show-help-overlay"))
         section_menu.append_item(Gio.MenuItem.new(label=_("About"), detailed_action="app.about"))
@@ -230,13 +407,12 @@ class ImaginerApplication(Adw.Application):
 
         window.menu.set_menu_model(self.menu_model)
 
-    def load(self):
-        for p in self.providers.values():
-            print(self.providers_data)
-            try:
-                p.load(data=json.loads(self.providers_data[p.slug]))
-            except KeyError:  # provider not in data
-                pass
+    def load_provider(self, p):
+        """Apply the saved data to a provider when it is first created."""
+        try:
+            p.load(data=json.loads(self.providers_data[p.slug]))
+        except KeyError:  # provider not in data
+            pass
 
     def on_about_action(self, widget, _):
         """Callback for the app.about action."""
@@ -281,6 +457,10 @@ Gtk: {Gtk.MAJOR_VERSION}.{Gtk.MINOR_VERSION}.{Gtk.MICRO_VERSION}
 Python: {platform.python_version()}
 OS: {platform.system()} {platform.release()} {platform.version()}
 Providers: {self.enabled_providers}
+Cache: {self.cache.stats() if self.cache else "disabled"}
+
+Metrics:
+{metrics.summary()}
 """
         )
         about.present()
@@ -296,81 +476,238 @@ Providers: {self.enabled_providers}
         """Callback for the app.choose_output action."""
         self.win.file_chooser.show()
 
-    def on_file_chooser_response(self, _, response):
+    def on_file_chooser_response(self, file_chooser, response, win):
         if response == Gtk.ResponseType.ACCEPT:
-            self.directory = self.win.file_chooser.get_file()
-            dir_basename = self.directory.get_basename()
-            self.win.label_output.set_label(dir_basename)
-            self.win.button_imagine.set_has_tooltip(False)
-
-        self.win.file_chooser.hide()
+            directory = file_chooser.get_file()
+            win.label_output.set_label(directory.get_basename())
+            win.button_imagine.set_has_tooltip(False)
+            win.file_path = directory.get_path()
 
-        if response == Gtk.ResponseType.ACCEPT:
-            self.file_path = self.directory.get_path()
-
-    def slugify(self, value):
-        value = (
-            unicodedata.normalize("NFKD", value)
-            .encode("ascii", "ignore")
-            .decode("ascii")
-        )
-        value = re.sub("[^\w\s-]", "", value).strip().lower()
-        return re.sub("[-\s]+", "-", value)
+        file_chooser.hide()
 
     def on_ask_action(self, widget, _):
         """Callback for the app.ask action."""
+        self.ask(self.win)
 
+    def on_regenerate_action(self, widget, _):
+        """Callback for the app.regenerate action, bypasses the result cache."""
+        self.ask(self.win, force=True)
 
-        self.prompt = self.win.prompt.get_text()
-        self.negative_prompt = self.win.negative_prompt.get_text()
+    def ask(self, win, force=False):
+        """Start a generation from the prompt of `win`.
 
-        try:
-            self.path = self.file_path
-        except AttributeError:
-            self.path = "imaginer"
+        Everything about the generation is local to this call and to the
+        window, so that several windows can generate at the same time and
+        each gets its own results.
+        """
+        win.button_history.set_active(False)
+        prompt = win.prompt.get_text()
+        negative_prompt = win.negative_prompt.get_text()
+
+        if win.file_path is None:
+            path = "imaginer"
         else:
-            self.path = f"{self.path}/imaginer-{self.slugify(self.prompt)}-{strftime('%d-%b-%Y-%H-%M-%S', gmtime())}"
+            path = output_base(win.file_path, prompt)
 
-        if self.prompt == "" or self.prompt is None:  # empty prompt
+        if prompt == "" or prompt is None:  # empty prompt
             return
         else:
-            self.win.spinner.start()
-            self.win.stack_imaginer.set_visible_child_name("stack_loading")
-
-            def thread_run():
-                try:
-                    image = self.providers[self.provider].ask(self.prompt, self.negative_prompt)
-                except GLib.Error as e:
-                    self.win.banner.set_title(str(e))
-                    self.win.banner.set_revealed(True)
+            win.spinner.start()
+            win.stack_imaginer.set_visible_child_name("stack_loading")
+            win.clear_results()
+            if win.switch_compare.get_active():
+                self.ask_compare(win, prompt, negative_prompt, path, force)
+                return
+            if self.provider == AUTO:
+                self.ask_auto(win, prompt, negative_prompt, path, force)
+                return
+
+            provider = self.providers[self.provider]
+            count = win.spin_count.get_value_as_int()
+            extension = self.generator.postprocess.options.extension
+            outputs = [
+                (i, provider.path(path, i if count > 1 else None, extension))
+                for i in range(1, count + 1)
+            ]
+            saved = []
+
+            # providers returning several images per request get them in chunks
+            size = provider.max_batch
+            on_wait = self.countdown_callback(win)
+            progress = TransferProgress(win)
+            calls = []
+            for i in range(0, count, size):
+                chunk = outputs[i : i + size]
+                job_id = self.queue.add(provider, prompt, negative_prompt, chunk, force)
+                calls.append((
+                    (self.generator, job_id, provider, prompt, negative_prompt, chunk),
+                    {"force": force, "on_wait": on_wait, "on_progress": progress},
+                ))
+
+            def on_state(job, state):
+                self.mark_provider(provider, job, state)
+                if state == JobState.DONE:
+                    for result in job.result:
+                        cleanup(result)
+                elif state == JobState.FAILED:
+                    win.show_error(job.error)
+
+                if batch.done:
+                    progress.finish()
+                if state >= JobState.DONE:
+                    win.set_progress(len(saved), count)
+                    if saved or batch.done:
+                        win.spinner.stop()
+                        win.stack_imaginer.set_visible_child_name("stack_imagine")
+
+            def cleanup(result):
+                if result:
+                    win.hide_error()
+                    saved.append(result.path)
+                    win.add_result(result)
+                    self.history.add(result, prompt, provider.slug)
+                    print("Image saved")
                 else:
-                    path = self.providers[self.provider].path(self.path)
-                    GLib.idle_add(cleanup, image, path)
-
-            def cleanup(image, path):
-                self.win.spinner.stop()
-                self.win.stack_imaginer.set_visible_child_name("stack_imagine")
-                self.t.join()
+                    print("No image returned")
 
+            batch = Batch(
+                self.jobs,
+                self.queue.run,
+                calls,
+                parallelism=self.settings.get_int("batch-parallelism"),
+                on_state=on_state,
+            )
+            win.track(batch.start(), [args[1] for args, _ in calls])
+
+    def countdown_callback(self, win):
+        """Return an `on_wait` callback that can be called from worker threads."""
+        def on_wait(error, seconds):
+            GLib.idle_add(win.show_countdown, error, seconds)
+        return on_wait
+
+    def ask_auto(self, win, prompt, negative_prompt, path, force=False):
+        """Send each image to the provider the router picks for it."""
+        providers = [self.providers[slug] for slug in self.providers]
+        loading = self.loading_providers()
+        count = win.spin_count.get_value_as_int()
+        extension = self.generator.postprocess.options.extension
+        on_wait = self.countdown_callback(win)
+        progress = TransferProgress(win)
+        saved = []
+
+        def generate(index, token=None):
+            def attempt(provider, token):
+                outputs = [(index, provider.path(path, index if count > 1 else None, extension))]
+                job_id = self.queue.add(provider, prompt, negative_prompt, outputs, force)
+                return job_id, self.queue.run(
+                    self.generator, job_id, provider, prompt, negative_prompt, outputs,
+                    force=force, token=token, on_wait=on_wait, on_progress=progress,
+                )
+            return self.router.run(providers, attempt, token, loading, discard=discard)
+
+        def discard(provider, result):
+            """Remove every trace of an image that lost the race."""
+            job_id, results = result
+            self.queue.delete(job_id)
+            for image in results:
                 if image:
-                    self.win.banner.set_revealed(False)
-                    image.save(path)
-                    self.win.image.set_file(Gio.File.new_for_path(path))
-                    self.win.image.set_visible(True)
-                    print("Image saved")
+                    self.index.remove(image.path)
+                    for file in [image.path, *image.derivatives]:
+                        try:
+                            os.remove(file)
+                        except OSError as e:
+                            print("Could not remove", file, e)
+
+        def on_state(job, state):
+            if state == JobState.DONE:
+                provider, (job_id, results) = job.result
+                self.mark_provider(provider, job, state)
+                if results[0]:
+                    win.hide_error()
+                    saved.append(results[0].path)
+                    win.add_result(results[0])
+                    self.history.add(results[0], prompt, provider.slug)
+                    print("Image saved from", provider.slug)
                 else:
                     print("No image returned")
-
-            
-            self.t = KillableThread(target=thread_run)
-            self.t.start()
+            elif state == JobState.FAILED:
+                win.show_error(job.error)
+
+            if batch.done:
+                progress.finish()
+                for window in self.get_windows():
+                    if isinstance(window, ImaginerWindow):
+                        self.update_provider_state(window)
+            if state >= JobState.DONE:
+                win.set_progress(len(saved), count)
+                if saved or batch.done:
+                    win.spinner.stop()
+                    win.stack_imaginer.set_visible_child_name("stack_imagine")
+
+        batch = Batch(
+            self.jobs,
+            generate,
+            [((i,), {}) for i in range(1, count + 1)],
+            parallelism=self.settings.get_int("batch-parallelism"),
+            on_state=on_state,
+        )
+        # the job queue rows are added once a provider is picked, and
+        # are cancelled through the batch's tokens
+        win.track(batch.start(), [])
+
+    def ask_compare(self, win, prompt, negative_prompt, path, force=False):
+        """Send the prompt to every enabled provider at once."""
+        group = JobGroup()
+        on_wait = self.countdown_callback(win)
+        progress = TransferProgress(win)
+
+        def on_state(provider, job, state):
+            if state < JobState.DONE:
+                return
+            if group.done:
+                progress.finish()
+            self.mark_provider(provider, job, state)
+            if state == JobState.DONE and job.result[0]:
+                win.add_provider_result(provider.name, job.result[0], latency=job.elapsed)
+                self.history.add(job.result[0], prompt, provider.slug)
+            elif state == JobState.DONE:
+                win.add_provider_result(provider.name, error=_("No image returned"))
+            elif state == JobState.FAILED:
+                win.add_provider_result(provider.name, error=job.error)
+            else:
+                return
+
+            finished = sum(1 for job in group.jobs if job.done)
+            win.set_progress(finished, len(group.jobs))
+            if finished == 1 or group.done:
+                win.spinner.stop()
+                win.stack_imaginer.set_visible_child_name("stack_imagine")
+
+        queued = []
+        for provider in self.providers.values():
+            outputs = [(1, provider.path(path, format=self.generator.postprocess.options.extension))]
+            job_id = self.queue.add(provider, prompt, negative_prompt, outputs, force)
+            queued.append(job_id)
+            group.add(self.jobs.submit(
+                self.queue.run,
+                self.generator,
+                job_id,
+                provider,
+                prompt,
+                negative_prompt,
+                outputs,
+                force=force,
+                on_wait=on_wait,
+                on_progress=progress,
+                on_state=lambda job, state, provider=provider: on_state(provider, job, state),
+            ))
+        win.track(group, queued)
 
     def on_stop_action(self, widget, _):
-        """Callback for the app.stop action."""
+        """Callback for the app.stop action, stops the active window's generations."""
         self.win.spinner.stop()
         self.win.stack_imaginer.set_visible_child_name("stack_imagine")
-        self.t.kill()
-        self.t.join()
+        self.win.stop()
 
     def create_action(self, name, callback, shortcuts=None):
         """Add an application action.
@@ -0,0 +1,304 @@
+# postprocess.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import functools
+import io
+import multiprocessing
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from xml.sax.saxutils import escape
+
+from .provider.metrics import metrics
+from .provider.output import ImageResult, save_bytes
+
+ASPECTS = ("", "1:1", "4:3", "3:2", "16:9", "3:4", "2:3", "9:16")
+METADATA = ("keep", "strip", "embed")
+FORMATS = ("", "png", "jpg", "webp", "avif")
+PIL_FORMATS = {"jpg": "JPEG", "png": "PNG", "webp": "WEBP", "avif": "AVIF", "gif": "GIF"}
+XMP_NAMESPACE = "https://imaginer.codeberg.page/ns/1.0/"
+
+
+class PostProcessOptions:
+    """What is done to every image once it is written.
+
+    `max_size` is the longest side in pixels and `aspect` a `W:H` ratio
+    to crop to, both off when empty. `sharpen` is the strength of an
+    unsharp mask in percent, `metadata` is one of `METADATA`, and each
+    width of `derivatives` gets a smaller copy next to the output.
+    `format` is one of `FORMATS`, empty to keep the provider's, with the
+    `quality` of lossy formats and the zlib `compression` level of PNG.
+    """
+
+    def __init__(self, max_size=0, aspect="", sharpen=0, metadata="keep", derivatives=(),
+                 format="", quality=90, compression=6):
+        self.max_size = max_size
+        self.aspect = aspect if aspect in ASPECTS else ""
+        self.sharpen = sharpen
+        self.metadata = metadata if metadata in METADATA else "keep"
+        self.derivatives = tuple(sorted({width for width in derivatives if width > 0}, reverse=True))
+        self.format = format if format in FORMATS else ""
+        self.quality = quality
+        self.compression = compression
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            max_size=settings.get_int("postprocess-max-size"),
+            aspect=settings.get_string("postprocess-aspect"),
+            sharpen=settings.get_int("postprocess-sharpen"),
+            metadata=settings.get_string("postprocess-metadata"),
+            derivatives=settings.get_value("postprocess-derivatives").unpack(),
+            format=settings.get_string("output-format"),
+            quality=settings.get_int("output-quality"),
+            compression=settings.get_int("output-compression"),
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.format or self.metadata != "keep" or self.reencodes(None))
+
+    @property
+    def extension(self):
+        """Extension of the outputs, before the providers' format is known."""
+        return self.format or "png"
+
+    def reencodes(self, format):
+        """Whether an image sent as `format` has to be decoded by Pillow."""
+        return bool(
+            self.max_size or self.aspect or self.sharpen or self.derivatives
+            or self.metadata == "strip" or (self.format and self.format != format)
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def available_formats():
+    """The `FORMATS` the installed Pillow can encode, empty included."""
+    try:
+        from PIL import features
+    except ImportError:
+        return ("",)
+    return tuple(format for format in FORMATS if format not in ("webp", "avif") or features.check(format))
+
+
+def xmp_packet(info):
+    """Return an XMP packet describing a generation, for JPEG, WebP and AVIF."""
+    fields = "".join(f"<imaginer:{key}>{escape(value)}</imaginer:{key}>" for key, value in info.items())
+    return (
+        '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        '<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/"'
+        f' xmlns:imaginer="{XMP_NAMESPACE}">'
+        '<dc:description><rdf:Alt><rdf:li xml:lang="x-default">'
+        f'{escape(info.get("prompt", ""))}'
+        '</rdf:li></rdf:Alt></dc:description>'
+        f"{fields}"
+        "</rdf:Description></rdf:RDF></x:xmpmeta>"
+        '<?xpacket end="r"?>'
+    ).encode("utf-8")
+
+
+def embed(data, format, info):
+    """Return `data` with `info` added, without decoding the image.
+
+    PNGs get an iTXt chunk per field right after their header, JPEGs an
+    XMP segment after their first one. Returns None for other formats,
+    which have to go through Pillow.
+    """
+    if format == "png":
+        chunks = b""
+        for key, value in info.items():
+            body = b"iTXt" + key.encode("latin-1") + b"\0\0\0\0\0" + value.encode("utf-8")
+            chunks += struct.pack(">I", len(body) - 4) + body + struct.pack(">I", zlib.crc32(body))
+        return data[:33] + chunks + data[33:]  # signature and IHDR
+    if format == "jpg":
+        segment = b"http://ns.adobe.com/xap/1.0/\0" + xmp_packet(info)
+        if len(segment) + 2 > 0xFFFF:
+            return None
+        offset = 2
+        if data[2:4] == b"\xff\xe0":  # JFIF must stay first
+            offset += 2 + struct.unpack(">H", data[4:6])[0]
+        return data[:offset] + b"\xff\xe1" + struct.pack(">H", len(segment) + 2) + segment + data[offset:]
+    return None
+
+
+def crop(image, aspect):
+    """Crop the center of `image` to the `W:H` ratio `aspect`."""
+    w, h = (int(n) for n in aspect.split(":"))
+    width, height = image.size
+    if width * h > height * w:
+        new = height * w // h
+        return image.crop(((width - new) // 2, 0, (width - new) // 2 + new, height))
+    new = width * h // w
+    return image.crop((0, (height - new) // 2, width, (height - new) // 2 + new))
+
+
+def encode(image, format, options, info, source):
+    """Return the bytes of `image` saved as `format`, with the chosen metadata.
+
+    `source` is the image as it was read, whose metadata is kept.
+    """
+    from PIL import Image, PngImagePlugin
+
+    params = {}
+    if source.info.get("icc_profile"):
+        params["icc_profile"] = source.info["icc_profile"]  # colors, not metadata
+    if format == "png":
+        text = PngImagePlugin.PngInfo()
+        if options.metadata == "keep":
+            for key, value in getattr(source, "text", {}).items():
+                text.add_text(key, value)
+        elif options.metadata == "embed":
+            for key, value in info.items():
+                text.add_itxt(key, value)
+        params["pnginfo"] = text
+        params["compress_level"] = options.compression
+    elif options.metadata == "keep":
+        for key in ("exif", "xmp"):
+            if source.info.get(key):
+                params[key] = source.info[key]
+    elif options.metadata == "embed":
+        exif = Image.Exif()
+        exif[0x010E] = info.get("prompt", "")  # ImageDescription
+        exif[0x0131] = info.get("provider", "")  # Software
+        params["exif"] = exif.tobytes()
+        params["xmp"] = xmp_packet(info)
+
+    if format in ("jpg", "webp", "avif"):
+        params["quality"] = options.quality
+    if format == "jpg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    elif format == "avif" and image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    output = io.BytesIO()
+    image.save(output, PIL_FORMATS[format], **params)
+    return output.getvalue()
+
+
+def process(path, format, options, info, derivatives):
+    """Apply `options` to the image at `path` and write its derivatives.
+
+    Runs in a worker process. `format` is the format to encode to and
+    `derivatives` lists the `(width, path)` of the smaller copies; returns
+    the `ImageResult` of the image, with the paths of the copies written.
+    """
+    from PIL import Image, ImageFilter
+
+    with Image.open(path) as source:
+        source.load()
+        image = source
+        if options.aspect:
+            image = crop(image, options.aspect)
+        if options.max_size and max(image.size) > options.max_size:
+            image = image.copy()
+            image.thumbnail((options.max_size, options.max_size), Image.LANCZOS)
+        if options.sharpen:
+            image = image.filter(ImageFilter.UnsharpMask(radius=2, percent=options.sharpen, threshold=3))
+        result = save_bytes(encode(image, format, options, info, source), path)
+        if result.path != path:
+            os.unlink(path)  # replaced by the new format
+
+        written = []
+        for width, derivative in derivatives:
+            if width >= image.width:
+                continue
+            copy = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+            written.append(save_bytes(encode(copy, format, options, info, source), derivative).path)
+    return ImageResult(result.path, result.data, result.format, written)
+
+
+class PostProcessor:
+    """Runs the post-processing of outputs in a pool of processes.
+
+    Decoding, filtering and encoding run in separate processes, so that
+    several images use several cores and the Python parts of the pipeline
+    do not compete with the application's threads. Callers are job engine
+    threads, which wait for their image; nothing here runs on the main
+    loop. The pool is started on first use, started again if a worker
+    dies, and `options` can be replaced at any time, for the next images.
+    """
+
+    def __init__(self, options=None, max_workers=None):
+        self.options = options or PostProcessOptions()
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                # forking a process with GTK and worker threads is unsafe
+                self._executor = ProcessPoolExecutor(
+                    self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def run(self, provider, prompt, negative_prompt, result):
+        """Post-process `result` and return its new `ImageResult`.
+
+        The path changes with the format, and the paths of the smaller
+        copies are kept in `derivatives`. When only the metadata is added,
+        it is done here without the pool. Errors are printed and leave the
+        image as the provider sent it.
+        """
+        options = self.options
+        if options.format and options.format not in available_formats():
+            print(f"Pillow cannot save {options.format} images, keeping the provider's format")
+            options.format = ""
+        if result is None or not options.enabled:
+            return result
+        info = {
+            "prompt": prompt,
+            "negative_prompt": negative_prompt or "",
+            "provider": provider.slug,
+            "model": provider.model or "",
+        }
+        derivatives = [(width, provider.derivative_path(result.path, width)) for width in options.derivatives]
+        try:
+            with metrics.span(provider.slug, "postprocess"):
+                if not options.reencodes(result.format):
+                    if options.metadata != "embed":
+                        return result  # already in the chosen format
+                    # only the metadata changes, which needs no decoding
+                    data = embed(result.data, result.format, info)
+                    if data is not None:
+                        return save_bytes(data, result.path)
+                return self.executor.submit(
+                    process, result.path, options.format or result.format, options, info, derivatives
+                ).result()
+        except BrokenProcessPool as e:
+            print(f"Post-processing failed: {e}")
+            with self._lock:
+                self._executor = None  # a new pool for the next image
+            return result
+        except Exception as e:
+            print(f"Post-processing failed: {e}")
+            return result
+
+    def shutdown(self, wait=True):
+        """Stop the pool; waiting lets it close its pipes before the interpreter exits."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
@@ -1,6 +1,10 @@
-from gi.repository import Gtk, Adw
+from gi.repository import Gtk, Adw, Gio, GLib
 
+from gettext import gettext as _
+
+from .postprocess import ASPECTS, METADATA, available_formats
 from .provider import PROVIDERS
+from .provider.metrics import metrics
 
 
 @Gtk.Template(resource_path="/page/codeberg/Imaginer/Imaginer/ui/preferences.ui")
@@ -8,6 +12,11 @@ class Preferences(Adw.PreferencesWindow):
     __gtype_name__ = "Preferences"
 
     provider_group = Gtk.Template.Child()
+    output_group = Gtk.Template.Child()
+    postprocess_group = Gtk.Template.Child()
+    usage_group = Gtk.Template.Child()
+    latency_group = Gtk.Template.Child()
+    errors_group = Gtk.Template.Child()
 
     def __init__(self, application, **kwargs):
         super().__init__(**kwargs)
@@ -15,6 +24,14 @@ class Preferences(Adw.PreferencesWindow):
         self.app = application
         self.settings = application.settings
         self.setup_providers()
+        self.setup_output()
+        self.setup_postprocess()
+        self.setup_usage()
+
+        self.metrics_rows = []
+        self.refresh_metrics()
+        self.metrics_source = GLib.timeout_add_seconds(2, self.refresh_metrics)
+        self.connect("close-request", self.on_close_request)
 
     def setup_providers(self):
         # for provider in self.app.providers.values():
@@ -26,10 +43,144 @@ class Preferences(Adw.PreferencesWindow):
         #     row = Adw.ActionRow()
         #     row.props.title = "No providers available"
         #     self.provider_group.add(row)
-        for provider in PROVIDERS.values():
+        for key in PROVIDERS:
             try:
                 self.provider_group.add(
-                    provider(self.app.win, self.app).preferences(self)
+                    PROVIDERS.instance(key, self.app, self.app.load_provider).preferences(self)
                 )
             except TypeError:
                 pass
+
+    def setup_output(self):
+        names = {"": _("As Sent by the Provider"), "png": "PNG", "jpg": "JPEG", "webp": "WebP", "avif": "AVIF"}
+        formats = available_formats()  # AVIF needs a recent Pillow
+        format_row = Adw.ComboRow()
+        format_row.props.title = _("Format")
+        format_row.set_model(Gtk.StringList.new([names[format] for format in formats]))
+        format = self.settings.get_string("output-format")
+        format_row.set_selected(formats.index(format) if format in formats else 0)
+        format_row.connect(
+            "notify::selected",
+            lambda row, *args: self.settings.set_string("output-format", formats[row.get_selected()]),
+        )
+        self.output_group.add(format_row)
+
+        quality_row = Adw.ActionRow()
+        quality_row.props.title = _("Quality")
+        quality_row.props.subtitle = _("JPEG, WebP and AVIF")
+        spin = Gtk.SpinButton.new_with_range(1, 100, 5)
+        spin.set_valign(Gtk.Align.CENTER)
+        self.settings.bind("output-quality", spin, "value", Gio.SettingsBindFlags.DEFAULT)
+        quality_row.add_suffix(spin)
+        self.output_group.add(quality_row)
+
+        compression_row = Adw.ActionRow()
+        compression_row.props.title = _("PNG Compression")
+        compression_row.props.subtitle = _("Higher levels are smaller and slower to save")
+        spin = Gtk.SpinButton.new_with_range(0, 9, 1)
+        spin.set_valign(Gtk.Align.CENTER)
+        self.settings.bind("output-compression", spin, "value", Gio.SettingsBindFlags.DEFAULT)
+        compression_row.add_suffix(spin)
+        self.output_group.add(compression_row)
+
+    def setup_postprocess(self):
+        size_row = Adw.ActionRow()
+        size_row.props.title = _("Maximum Size")
+        size_row.props.subtitle = _("Longest side in pixels, 0 to keep the size")
+        spin = Gtk.SpinButton.new_with_range(0, 8192, 64)
+        spin.set_valign(Gtk.Align.CENTER)
+        self.settings.bind("postprocess-max-size", spin, "value", Gio.SettingsBindFlags.DEFAULT)
+        size_row.add_suffix(spin)
+        self.postprocess_group.add(size_row)
+
+        aspect_row = Adw.ComboRow()
+        aspect_row.props.title = _("Crop to Aspect Ratio")
+        aspect_row.set_model(Gtk.StringList.new([_("Original")] + list(ASPECTS[1:])))
+        aspect = self.settings.get_string("postprocess-aspect")
+        aspect_row.set_selected(ASPECTS.index(aspect) if aspect in ASPECTS else 0)
+        aspect_row.connect(
+            "notify::selected",
+            lambda row, *args: self.settings.set_string("postprocess-aspect", ASPECTS[row.get_selected()]),
+        )
+        self.postprocess_group.add(aspect_row)
+
+        sharpen_row = Adw.ActionRow()
+        sharpen_row.props.title = _("Sharpen")
+        sharpen_row.props.subtitle = _("Strength in percent, 0 to disable")
+        spin = Gtk.SpinButton.new_with_range(0, 500, 10)
+        spin.set_valign(Gtk.Align.CENTER)
+        self.settings.bind("postprocess-sharpen", spin, "value", Gio.SettingsBindFlags.DEFAULT)
+        sharpen_row.add_suffix(spin)
+        self.postprocess_group.add(sharpen_row)
+
+        metadata_row = Adw.ComboRow()
+        metadata_row.props.title = _("Metadata")
+        metadata_row.set_model(Gtk.StringList.new([_("Keep"), _("Strip"), _("Embed the Prompt")]))
+        metadata = self.settings.get_string("postprocess-metadata")
+        metadata_row.set_selected(METADATA.index(metadata) if metadata in METADATA else 0)
+        metadata_row.connect(
+            "notify::selected",
+            lambda row, *args: self.settings.set_string("postprocess-metadata", METADATA[row.get_selected()]),
+        )
+        self.postprocess_group.add(metadata_row)
+
+        self.derivatives_row = Adw.EntryRow()
+        self.derivatives_row.props.title = _("Web Sizes, in Pixels Wide")
+        self.derivatives_row.set_show_apply_button(True)
+        self.derivatives_row.props.text = ", ".join(
+            str(width) for width in self.settings.get_value("postprocess-derivatives").unpack()
+        )
+        self.derivatives_row.connect("apply", self.on_derivatives_apply)
+        self.postprocess_group.add(self.derivatives_row)
+
+    def on_derivatives_apply(self, row):
+        widths = [int(width) for width in row.get_text().replace(",", " ").split() if width.isdigit()]
+        row.props.text = ", ".join(str(width) for width in widths)
+        self.settings.set_value("postprocess-derivatives", GLib.Variant("ai", widths))
+
+    def setup_usage(self):
+        usage = self.app.ledger.summary()
+        names = {info.slug: info.name for info in PROVIDERS.infos()}
+        for key, total in sorted(usage.items()):
+            slug, key_hash = key.split(":", 1)
+            row = Adw.ActionRow()
+            row.props.title = names.get(slug, slug)
+            if key_hash != "anonymous":
+                row.props.subtitle = _("API key {}…").format(key_hash[:6])
+            row.add_suffix(Gtk.Label(
+                label=_("{} requests · {} images · ${:.2f}").format(
+                    total["requests"], total["images"], total["cost"]
+                )
+            ))
+            self.usage_group.add(row)
+        if not usage:
+            row = Adw.ActionRow()
+            row.props.title = _("No requests yet")
+            self.usage_group.add(row)
+
+    def refresh_metrics(self):
+        for group, row in self.metrics_rows:
+            group.remove(row)
+        self.metrics_rows = []
+
+        rows, errors = metrics.snapshot()
+        for provider, stage, count, p50, p95, p99 in rows:
+            row = Adw.ActionRow()
+            row.props.title = f"{provider} · {stage}"
+            row.props.subtitle = _("{} samples").format(count)
+            row.add_suffix(Gtk.Label(
+                label=f"p50 {p50:.2f} s · p95 {p95:.2f} s · p99 {p99:.2f} s"
+            ))
+            self.latency_group.add(row)
+            self.metrics_rows.append((self.latency_group, row))
+        for (provider, error), count in sorted(errors.items()):
+            row = Adw.ActionRow()
+            row.props.title = f"{provider} · {error}"
+            row.add_suffix(Gtk.Label(label=str(count)))
+            self.errors_group.add(row)
+            self.metrics_rows.append((self.errors_group, row))
+        return GLib.SOURCE_CONTINUE
+
+    def on_close_request(self, *args):
+        GLib.source_remove(self.metrics_source)
+        return False
@@ -0,0 +1,144 @@
+# progress.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import threading
+import time
+
+from gi.repository import Gdk, GdkPixbuf, GLib
+
+from .provider.output import is_progressive
+
+FRAME = 1 / 60  # seconds between two updates of the window
+PREVIEW_INTERVAL = 0.25  # seconds between two preview snapshots
+PREVIEW_SIZE = 256  # pixels on the longest side of a preview
+HEADER_LIMIT = 64 * 1024  # bytes read to look for a progressive image
+
+
+class _Transfer:
+    """Download of one image: its size so far and its partial decoder."""
+
+    def __init__(self, total):
+        self.received = 0
+        self.total = total
+        self.header = b""
+        self.loader = None
+        self.checked = False
+
+    def feed(self, chunk):
+        self.received += len(chunk)
+        if self.checked:
+            if self.loader is not None:
+                self.write(chunk)
+            return
+        self.header += chunk
+        if is_progressive(self.header):
+            self.checked = True
+            self.loader = GdkPixbuf.PixbufLoader()
+            self.loader.connect("size-prepared", self.on_size_prepared)
+            self.write(self.header)
+            self.header = b""
+        elif len(self.header) >= HEADER_LIMIT:
+            self.checked = True
+            self.header = b""
+
+    def write(self, data):
+        try:
+            self.loader.write(data)
+        except GLib.Error:
+            self.close()
+
+    def on_size_prepared(self, loader, width, height):
+        scale = min(1.0, PREVIEW_SIZE / max(width, height, 1))
+        loader.set_size(max(1, int(width * scale)), max(1, int(height * scale)))
+
+    def snapshot(self):
+        """Return a copy of what was decoded so far, or None."""
+        pixbuf = self.loader.get_pixbuf() if self.loader is not None else None
+        return pixbuf.copy() if pixbuf is not None else None
+
+    def close(self):
+        if self.loader is None:
+            return
+        try:
+            self.loader.close()
+        except GLib.Error:
+            pass  # the download was cut short
+        self.loader = None
+
+
+class TransferProgress:
+    """Follows the downloads of a generation and shows them in `win`.
+
+    The instance is the `on_progress` callback of the providers, so it
+    is called from worker threads for every chunk received. The window
+    is updated from `GLib.idle_add` at most once per frame, and images
+    that are sent in passes, interlaced PNGs and progressive JPEGs, are
+    decoded as they arrive to show a low resolution preview.
+    """
+
+    def __init__(self, win):
+        self.win = win
+        self.transfers = {}
+        self.start = time.monotonic()
+        self.first_chunk = None
+        self.updated = 0.0
+        self.previewed = 0.0
+        self.preview = None
+        self.pending = False
+        self._lock = threading.Lock()
+
+    def __call__(self, path, chunk, total):
+        with self._lock:
+            now = time.monotonic()
+            if self.first_chunk is None:
+                self.first_chunk = now
+            transfer = self.transfers.get(path)
+            if transfer is None:
+                transfer = self.transfers[path] = _Transfer(total)
+            transfer.feed(chunk)
+            if transfer.loader is not None and now - self.previewed >= PREVIEW_INTERVAL:
+                self.preview = transfer.snapshot() or self.preview
+                self.previewed = now
+            if self.pending or now - self.updated < FRAME:
+                return
+            self.pending = True
+        GLib.idle_add(self.update)
+
+    def update(self):
+        with self._lock:
+            now = time.monotonic()
+            self.pending = False
+            self.updated = now
+            received = sum(t.received for t in self.transfers.values())
+            total = sum(t.total for t in self.transfers.values())
+            if any(not t.total for t in self.transfers.values()):
+                total = 0  # unknown for at least one image
+            downloading = now - (self.first_chunk or now)
+            rate = received / downloading if downloading > 0 else 0
+            preview, self.preview = self.preview, None
+        texture = Gdk.Texture.new_for_pixbuf(preview) if preview is not None else None
+        self.win.show_transfer(received, total, rate, now - self.start, texture)
+        return GLib.SOURCE_REMOVE
+
+    def finish(self):
+        """Release the decoders once every download is over."""
+        with self._lock:
+            for transfer in self.transfers.values():
+                transfer.close()
+            self.transfers.clear()
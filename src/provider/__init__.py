@@ -1,19 +1,164 @@
-from .analogdiffusion import AnalogDiffusionProvider
-from .anything import AnythingProvider
-from .nitrodiffusion import NitroDiffusionProvider
-from .openai import OpenAIProvider
-from .openjourney import OpenJourneyProvider
-from .portraitplus import PortraitPlusProvider
-from .stablediffusion import StableDiffusionProvider
-from .waifudiffusion import WaifuDiffusionProvider
-
-PROVIDERS = {
-    "analogdiffusion": AnalogDiffusionProvider,
-    "anything": AnythingProvider,
-    "nitrodiffusion": NitroDiffusionProvider,
-    "openai": OpenAIProvider,
-    "openjourney": OpenJourneyProvider,
-    "portraitplus": PortraitPlusProvider,
-    "stablediffusion": StableDiffusionProvider,
-    "waifudiffusion": WaifuDiffusionProvider,
-}
+from collections.abc import Mapping
+from importlib import import_module
+from importlib.metadata import entry_points
+import threading
+
+ENTRY_POINT_GROUP = "imaginer.providers"
+
+
+class ProviderInfo:
+    """What is known about a provider without importing its module.
+
+    `warm_up` tells whether the provider has models that can be woken up
+    ahead of a generation.
+    """
+
+    def __init__(self, key, name, slug, model=None, module=None, attr=None, entry_point=None, warm_up=False):
+        self.key = key
+        self.name = name
+        self.slug = slug
+        self.model = model
+        self.module = module
+        self.attr = attr
+        self.entry_point = entry_point
+        self.warm_up = warm_up
+
+    def load(self):
+        if self.entry_point is not None:
+            return self.entry_point.load()
+        return getattr(import_module(self.module, __name__), self.attr)
+
+
+BUILTIN_PROVIDERS = [
+    ProviderInfo("analogdiffusion", "Analog Diffusion", "analogdiffusion", "wavymulder/Analog-Diffusion",
+                 ".analogdiffusion", "AnalogDiffusionProvider", warm_up=True),
+    ProviderInfo("anything", "Anything", "anything", "andite/anything-v4.0",
+                 ".anything", "AnythingProvider", warm_up=True),
+    ProviderInfo("nitrodiffusion", "Nitro Diffusion", "nitrodiffusion", "nitrosocke/Nitro-Diffusion",
+                 ".nitrodiffusion", "NitroDiffusionProvider", warm_up=True),
+    ProviderInfo("openai", "Open AI", "openai", "dall-e",
+                 ".openai", "OpenAIProvider"),
+    ProviderInfo("openjourney", "Open Journey", "openjourney", "prompthero/openjourney-v4",
+                 ".openjourney", "OpenJourneyProvider", warm_up=True),
+    ProviderInfo("portraitplus", "Portrail Plus", "portrailplus", "wavymulder/portraitplus",
+                 ".portraitplus", "PortraitPlusProvider", warm_up=True),
+    ProviderInfo("stablediffusion", "Stable Diffusion", "stablediffusion", "stabilityai/stable-diffusion-2-1",
+                 ".stablediffusion", "StableDiffusionProvider", warm_up=True),
+    ProviderInfo("waifudiffusion", "Waifu Diffusion", "waifudiffusion", "hakurei/waifu-diffusion",
+                 ".waifudiffusion", "WaifuDiffusionProvider", warm_up=True),
+]
+
+
+class ProviderRegistry(Mapping):
+    """Maps provider keys to provider classes, importing them on first use.
+
+    Names, slugs and models of the built-in providers are known up front,
+    so menus can be built without importing any SDK. Third-party providers
+    are discovered through the `imaginer.providers` entry point group, the
+    entry point name being the key. Instances are cached with `instance()`.
+    """
+
+    def __init__(self, providers=()):
+        self._infos = {}
+        self._classes = {}
+        self._instances = {}
+        self._discovered = False
+        self._lock = threading.RLock()
+        for info in providers:
+            self.register(info)
+
+    def register(self, info):
+        self._infos[info.key] = info
+
+    def discover(self):
+        if self._discovered:
+            return
+        self._discovered = True
+        try:
+            found = entry_points(group=ENTRY_POINT_GROUP)
+        except Exception as e:  # broken metadata must not prevent startup
+            print("Could not discover providers:", e)
+            return
+        for entry_point in found:
+            if entry_point.name not in self._infos:
+                self.register(ProviderInfo(
+                    entry_point.name, entry_point.name, entry_point.name, entry_point=entry_point
+                ))
+
+    def info(self, key):
+        self.discover()
+        return self._infos[key]
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                return self._classes[key]
+            except KeyError:
+                pass
+            info = self.info(key)
+            provider = info.load()
+            info.name, info.slug, info.model = provider.name, provider.slug, provider.model
+            self._classes[key] = provider
+            return provider
+
+    def __iter__(self):
+        self.discover()
+        return iter(list(self._infos))
+
+    def __len__(self):
+        self.discover()
+        return len(self._infos)
+
+    def infos(self):
+        self.discover()
+        return list(self._infos.values())
+
+    def instance(self, key, app=None, on_create=None):
+        """Return the shared instance of a provider, creating it if needed.
+
+        `on_create` is called with a new instance before it is returned,
+        to load its saved data.
+        """
+        with self._lock:
+            try:
+                return self._instances[key]
+            except KeyError:
+                provider = self[key](app)
+                if on_create is not None:
+                    on_create(provider)
+                self._instances[key] = provider
+                return provider
+
+    def created(self):
+        """Return the instances created so far."""
+        return list(self._instances.values())
+
+
+class ProviderInstances(Mapping):
+    """The enabled providers by slug, instantiated on first access."""
+
+    def __init__(self, registry, keys, app=None, on_create=None):
+        self.registry = registry
+        self.app = app
+        self.on_create = on_create
+        self._keys = {}
+        for key in keys:
+            try:
+                self._keys[registry.info(key).slug] = key
+            except KeyError:
+                print("Provider", key, "not found")
+
+    def __getitem__(self, slug):
+        return self.registry.instance(self._keys[slug], self.app, self.on_create)
+
+    def info(self, slug):
+        return self.registry.info(self._keys[slug])
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+
+PROVIDERS = ProviderRegistry(BUILTIN_PROVIDERS)
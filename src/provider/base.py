@@ -1,34 +1,77 @@
-from gettext import gettext as _
-
-from gi.repository import Gtk, Adw, GLib
-
 import json
+import os
+
+# Gtk and Adw are imported inside the widget methods only, so that the
+# providers can be used by the headless command line without loading GTK.
 
 
 class ImaginerProvider:
     name = None
     slug = None
+    model = None
     description = ""
     languages = ""
     version = "0.1.7"
     developer_name = "0xMRTT"
     developers = ["0xMRTT https://github.com/0xMRTT"]
-    license_type = Gtk.License.GPL_3_0
     copyright = "© 2023 0xMRTT"
     url = "https://imaginer.codeberg.page/help/bard"
+    max_batch = 1  # images returned by a single request
+    cost_per_image = 0.0  # estimated, in US dollars
 
 
-    def __init__(self, win, app, *args, **kwargs):
-        self.win = win
-        self.banner = win.banner
+    def __init__(self, app=None, *args, **kwargs):
+        # the app is only used by the preferences widgets, generation never
+        # touches the UI so that one instance serves every window and the CLI
         self.app = app
         self.chat = None
 
-    def ask(self, prompt, negative_prompt):
+    @property
+    def license_type(self):
+        from gi.repository import Gtk
+
+        return Gtk.License.GPL_3_0
+
+    def ask(self, prompt, negative_prompt, path, token=None, on_progress=None):
+        """Generate an image and stream it to `path`.
+
+        Returns an `ImageResult`, whose path may have a different extension
+        if the provider did not send a PNG. Failures raise a `ProviderError`
+        subclass; this runs on worker threads and must not touch widgets.
+        `on_progress(path, chunk, total)` is called with every chunk of the
+        image received, `total` being the expected size or 0 if unknown.
+        """
         raise NotImplementedError()
 
-    def path(self, path):
-        return f"{path}-{self.slug}.png"
+    def ask_batch(self, prompt, negative_prompt, paths, token=None, on_progress=None):
+        """Return a list of `ImageResult` generated by a single request.
+
+        Only used when `max_batch` is greater than one.
+        """
+        raise NotImplementedError()
+
+    def warm_up(self, token=None):
+        """Ask the service to load the model, without generating an image.
+
+        Returns "warm", "loading" or "cold", or None if the provider has no
+        notion of a cold model or its state could not be found out. Must
+        never fall back to generating an image.
+        """
+        return None
+
+    def params(self):
+        """Generation parameters, other than the prompts, that affect the output."""
+        return {}
+
+    def path(self, path, index=None, format="png"):
+        if index is None:
+            return f"{path}-{self.slug}.{format}"
+        return f"{path}-{self.slug}-{index}.{format}"
+
+    def derivative_path(self, path, width):
+        """Path of the `width` pixels wide copy of the output `path()` named."""
+        base, extension = os.path.splitext(path)
+        return f"{base}-{width}w{extension}"
 
     @property
     def require_api_key(self):
@@ -37,26 +80,13 @@ class ImaginerProvider:
     def preferences(self, win):
         return self.no_preferences(win)
 
-    def no_api_key(self, title=None):
-        if title:
-            self.win.banner.props.title = title
-        else:
-            self.win.banner.props.title = _(
-                "No API key provided, you can provide one in settings"
-            )
-        self.win.banner.props.button_label = _("Open settings")
-        self.win.banner.connect("button-clicked", self.app.on_preferences_action)
-        self.win.banner.set_revealed(True)
-
-    def no_connection(self):
-        self.win.banner.props.title = _("No network connection")
-        self.win.banner.props.button_label = ""
-        self.win.banner.set_revealed(True)
-
     def hide_banner(self):
-        self.win.banner.set_revealed(False)
+        if self.app is not None:
+            self.app.hide_errors()
 
     def about(self, *args, **kwargs):
+        from gi.repository import Gtk
+
         popover = Gtk.Popover()
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         title = Gtk.Label()
@@ -87,11 +117,15 @@ class ImaginerProvider:
         return about_button
 
     def open_documentation(self, *args, **kwargs):
+        from gi.repository import GLib
+
         GLib.spawn_command_line_async(
             f"xdg-open {self.url}"
         )
     
     def how_to_get_a_token(self):
+        from gi.repository import Gtk
+
         about_button = Gtk.Button()
         about_button.set_icon_name("dialog-information-symbolic")
         about_button.set_tooltip_text("How to get a token")
@@ -101,6 +135,8 @@ class ImaginerProvider:
         return about_button
 
     def enable_switch(self):
+        from gi.repository import Gtk
+
         enabled = Gtk.Switch()
         enabled.set_active(self.slug in self.app.enabled_providers)
         enabled.connect("notify::active", self.on_enabled)
@@ -108,6 +144,8 @@ class ImaginerProvider:
         return enabled
 
     def no_preferences(self, win):
+        from gi.repository import Adw
+
         self.pref_win = win
 
         self.expander = Adw.ExpanderRow()
@@ -0,0 +1,59 @@
+import threading
+
+
+class Cancelled(Exception):
+    """Raised inside a job once its cancel token has been triggered."""
+
+
+class CancelToken:
+    """Cooperative cancellation flag shared between a job and its caller.
+
+    Callbacks registered with `add_callback` run as soon as the token is
+    cancelled, which lets the transport close an in-flight response from
+    another thread instead of waiting for the worker to notice.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reason = None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:  # the token must always finish cancelling
+                print("Cancel callback failed:", e)
+
+    def add_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError:
+                pass
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+    def wait(self, timeout=None):
+        """Sleep for `timeout` seconds, returning early with True if cancelled."""
+        return self._event.wait(timeout)
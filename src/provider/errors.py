@@ -0,0 +1,49 @@
+from gettext import gettext as _
+
+
+class ProviderError(Exception):
+    """A generation failed; `str()` is a message that can be shown as is."""
+
+    def __init__(self, message=None):
+        super().__init__(message or _("The provider returned an error"))
+        self.message = str(self)
+
+
+class AuthError(ProviderError):
+    def __init__(self, message=None):
+        super().__init__(message or _("No API key provided, you can provide one in settings"))
+
+
+class QuotaError(ProviderError):
+    """Rate limited or out of quota, `retry_after` is in seconds if known.
+
+    `retryable` is False when the quota is used up rather than the rate
+    limit hit, as waiting will not help.
+    """
+
+    def __init__(self, message=None, retry_after=None, retryable=True):
+        super().__init__(message or _("You exceeded your current quota, please check your plan and billing details."))
+        self.retry_after = retry_after
+        self.retryable = retryable
+
+
+class ModelLoadingError(ProviderError):
+    """The model is cold, `estimated_time` is in seconds if known."""
+
+    def __init__(self, message=None, estimated_time=None):
+        super().__init__(message or _("The model is loading"))
+        self.estimated_time = estimated_time
+
+
+class NetworkError(ProviderError):
+    def __init__(self, message=None):
+        super().__init__(message or _("No network connection"))
+
+
+class ServerError(ProviderError):
+    """The service failed with a 5xx status, usually worth retrying."""
+
+    def __init__(self, message=None, status_code=None, retry_after=None):
+        super().__init__(message or _("The provider is unavailable, please try again later"))
+        self.status_code = status_code
+        self.retry_after = retry_after
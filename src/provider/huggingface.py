@@ -1,70 +1,110 @@
-import requests
 import json
+import os
 from .base import ImaginerProvider
-
-import socket
-
-from gi.repository import Gtk, Adw, GLib
-from PIL import Image, UnidentifiedImageError
-import io
+from .errors import AuthError, ModelLoadingError, ProviderError, QuotaError, ServerError
+from .metrics import metrics
+from .output import NotAnImage, save_stream
+from .transport import transport
 
 class BaseHFProvider(ImaginerProvider):
     name = None
     slug = None
     model = None
     url = "https://imaginer.codeberg.page/help/huggingface"
+    # overridable to point the providers at a local stand-in, see benchmarks/
+    api_url = os.environ.get("IMAGINER_HF_API_URL", "https://api-inference.huggingface.co")
 
-    def __init__(self, win, app, *args, **kwargs):
-        super().__init__(win, app, *args, **kwargs)
+    def __init__(self, app=None, *args, **kwargs):
+        super().__init__(app, *args, **kwargs)
         self.api_key = None
 
-    def ask(self, prompt, negative_prompt):
+    def headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.require_api_key and self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def ask(self, prompt, negative_prompt, path, token=None, on_progress=None):
+        payload = json.dumps(
+            {
+                "inputs": prompt,
+                "negative_prompts": negative_prompt if negative_prompt else "",
+            }
+        )
+        url = f"{self.api_url}/models/{self.model}"
+        with metrics.span(self.slug, "request"):
+            response = transport.post(url, headers=self.headers(), data=payload, token=token, stream=True)
         try:
-            payload = json.dumps(
-                {
-                    "inputs": prompt,
-                    "negative_prompts": negative_prompt if negative_prompt else "",
-                }
-            )
-            headers = {"Content-Type": "application/json"}
-            if self.require_api_key and self.api_key:
-                headers["Authorization"] = f"Bearer {self.api_key}"
-            url = f"https://api-inference.huggingface.co/models/{self.model}"
-            response = requests.request("POST", url, headers=headers, data=payload)
-            if response.status_code == 403:
-                self.no_api_key()
-                return ""
-            elif response.status_code != 200:
-                self.win.banner.props.title = response.json()["error"]
-                self.win.banner.props.button_label = ""
-                self.win.banner.set_revealed(True)
-                return ""
-            response = response.content
-        except KeyError:
-            print("KeyError")
+            metrics.observe(self.slug, "compute", float(response.headers["x-compute-time"]))
+        except (KeyError, ValueError):  # not reported by every deployment
             pass
-        except socket.gaierror:
-            self.no_connection()
-            return ""
-        else:
-            self.hide_banner()
-            if response:
-                try:
-                    return Image.open(io.BytesIO(response))
-                except UnidentifiedImageError:
-                    error = json.loads(response)["error"]
-                    self.win.banner.set_title(error)
-                    self.win.banner.set_revealed(True)
-                    return None
-            else:
-                print("No response")
-                return None
+        if response.status_code != 200:
+            raise self.error(response.status_code, response.content, response.headers)
+        try:
+            on_chunk = None
+            if on_progress is not None:
+                total = int(response.headers.get("Content-Length") or 0)
+                on_chunk = lambda chunk: on_progress(path, chunk, total)
+            with metrics.span(self.slug, "download"):
+                return save_stream(transport.chunks(response, token), path, on_chunk)
+        except NotAnImage as e:
+            raise self.error(response.status_code, e.data, response.headers)
+
+    def warm_up(self, token=None):
+        url = f"{self.api_url}/status/{self.model}"
+        response = transport.get(url, headers=self.headers(), token=token)
+        if response.status_code != 200:
+            return None
+        try:
+            status = response.json()
+        except ValueError:
+            return None
+        if not isinstance(status, dict):
+            return None
+        if status.get("loaded"):
+            return "warm"
+
+        # only a model known to be cold is sent a request, which starts
+        # loading it and returns at once instead of generating an image
+        url = f"{self.api_url}/models/{self.model}"
+        payload = json.dumps({"inputs": "warm up", "options": {"wait_for_model": False}})
+        response = transport.post(url, headers=self.headers(), data=payload, token=token, stream=True)
+        response.close()
+        if response.status_code == 200:
+            return "warm"
+        elif isinstance(self.error(response.status_code, response.content, response.headers), ModelLoadingError):
+            return "loading"
+        return "cold"
+
+    def error(self, status_code, body, headers):
+        """Map an error response of the inference API to a ProviderError."""
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        message = data.get("error")
+        if isinstance(message, list):
+            message = "\n".join(message)
+
+        if status_code in (401, 403):
+            return AuthError()
+        elif status_code == 429:
+            return QuotaError(message, retry_after=headers.get("Retry-After"))
+        elif "estimated_time" in data:
+            return ModelLoadingError(message, estimated_time=data["estimated_time"])
+        elif status_code >= 500:
+            return ServerError(message, status_code, retry_after=headers.get("Retry-After"))
+        return ProviderError(message or f"HTTP {status_code}")
 
     @property
     def require_api_key(self):
         return True
 
     def preferences(self, win):
+        from gi.repository import Adw
+
         if self.require_api_key:
             self.expander = Adw.ExpanderRow()
             self.expander.props.title = self.name
@@ -0,0 +1,157 @@
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stages of a generation, in the order they happen:
+#   wait         queued in the rate limiter
+#   request      from sending the request to the response headers, which
+#                includes connecting, TLS and the service's own queue
+#   connect      DNS lookup and TCP connect of a new connection, by host
+#   tls          TLS handshake of a new connection, by host
+#   compute      inference time reported by the service, when it does
+#   download     streaming the body to disk
+#   postprocess  resizing, cropping and re-encoding the image
+#   total        the whole generation, retries included
+#   decode       building the texture shown in the window
+#   stall        a main loop dispatch blocked past the watchdog's threshold
+STAGES = ("wait", "request", "connect", "tls", "compute", "download", "postprocess", "total", "decode", "stall")
+
+
+class Histogram:
+    """Latencies of one stage, with percentiles over the latest samples."""
+
+    def __init__(self, size=1024):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, q):
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class Metrics:
+    """Per-provider latency histograms and error counters.
+
+    Everything is keyed by provider slug and stage, and is safe to update
+    from the job engine's threads. `summary()` is meant for humans,
+    `prometheus()` for the text exposition format.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def observe(self, provider, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get((provider, stage))
+            if histogram is None:
+                histogram = self.histograms[(provider, stage)] = Histogram()
+            histogram.observe(seconds)
+
+    def error(self, provider, error):
+        key = (provider, type(error).__name__)
+        with self._lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    @contextmanager
+    def span(self, provider, stage):
+        """Time the body of the `with` block as `stage` of `provider`."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(provider, stage, time.monotonic() - start)
+
+    def snapshot(self):
+        """Return `(provider, stage, count, p50, p95, p99)` rows and the error counts."""
+        with self._lock:
+            rows = [
+                (provider, stage, h.count, h.percentile(0.5), h.percentile(0.95), h.percentile(0.99))
+                for (provider, stage), h in self.histograms.items()
+            ]
+            errors = dict(self.errors)
+        rows.sort(key=lambda row: (row[0], STAGES.index(row[1]) if row[1] in STAGES else len(STAGES)))
+        return rows, errors
+
+    def summary(self):
+        rows, errors = self.snapshot()
+        lines = [
+            f"{provider} {stage}: n={count} p50={p50:.3f}s p95={p95:.3f}s p99={p99:.3f}s"
+            for provider, stage, count, p50, p95, p99 in rows
+        ]
+        lines += [f"{provider} {error}: {count}" for (provider, error), count in sorted(errors.items())]
+        return "\n".join(lines) or "No generations yet"
+
+    def prometheus(self):
+        with self._lock:
+            histograms = [(key, h.count, h.sum, sorted(h.samples)) for key, h in self.histograms.items()]
+            errors = dict(self.errors)
+        lines = [
+            "# HELP imaginer_stage_seconds Latency of each stage of a generation.",
+            "# TYPE imaginer_stage_seconds summary",
+        ]
+        for (provider, stage), count, total, samples in sorted(histograms):
+            labels = f'provider="{provider}",stage="{stage}"'
+            for q in (0.5, 0.95, 0.99):
+                value = samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+                lines.append(f'imaginer_stage_seconds{{{labels},quantile="{q}"}} {value}')
+            lines.append(f"imaginer_stage_seconds_sum{{{labels}}} {total}")
+            lines.append(f"imaginer_stage_seconds_count{{{labels}}} {count}")
+        lines += [
+            "# HELP imaginer_errors_total Failed requests by error type.",
+            "# TYPE imaginer_errors_total counter",
+        ]
+        for (provider, error), count in sorted(errors.items()):
+            lines.append(f'imaginer_errors_total{{provider="{provider}",error="{error}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Atomically write the metrics for a textfile collector."""
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.prometheus())
+            os.replace(tmp, path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+    def serve(self, port):
+        """Serve the metrics on http://127.0.0.1:`port`/metrics from a daemon thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True, name="imaginer-metrics").start()
+        return server
+
+
+metrics = Metrics()
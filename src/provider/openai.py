@@ -1,12 +1,29 @@
 from .base import ImaginerProvider
+from .errors import AuthError, NetworkError, ProviderError, QuotaError, ServerError
+from .metrics import metrics
+from .output import image_format, save_bytes
+from .transport import transport
 
+import base64
+import binascii
 import openai
-import socket
-
-from gi.repository import Gtk, Adw, GLib
-
-from PIL import Image, UnidentifiedImageError
-import io
+from gettext import gettext as _
+
+SIZES = ["256x256", "512x512", "1024x1024", "1792x1024", "1024x1792"]
+QUALITIES = ["standard", "hd"]
+
+# estimated US dollars per image, by model, quality and size
+PRICES = {
+    ("dall-e-2", "standard", "256x256"): 0.016,
+    ("dall-e-2", "standard", "512x512"): 0.018,
+    ("dall-e-2", "standard", "1024x1024"): 0.02,
+    ("dall-e-3", "standard", "1024x1024"): 0.04,
+    ("dall-e-3", "standard", "1792x1024"): 0.08,
+    ("dall-e-3", "standard", "1024x1792"): 0.08,
+    ("dall-e-3", "hd", "1024x1024"): 0.08,
+    ("dall-e-3", "hd", "1792x1024"): 0.12,
+    ("dall-e-3", "hd", "1024x1792"): 0.12,
+}
 
 class OpenAIProvider(ImaginerProvider):
     name = "Open AI"
@@ -14,57 +31,96 @@ class OpenAIProvider(ImaginerProvider):
     version = "0.1.0"
     api_key_title = "API Key"
     url = "https://imaginer.codeberg.page/help/openai"
+    model = "dall-e"
+    size = "1024x1024"
+    quality = "standard"
+    images_per_request = 10
 
-    def __init__(self, win, app, *args, **kwargs):
-        super().__init__(win, app, *args, **kwargs)
+    def __init__(self, app=None, *args, **kwargs):
+        super().__init__(app, *args, **kwargs)
         self.chat = openai.ChatCompletion
 
-    def ask(self, prompt, negative_prompt):
+    def ask(self, prompt, negative_prompt, path, token=None, on_progress=None):
+        return self.ask_batch(prompt, negative_prompt, [path], token=token, on_progress=on_progress)[0]
+
+    @property
+    def image_model(self):
+        """The API model: only DALL·E 3 has HD quality and non-square sizes."""
+        if self.quality != "standard" or self.size in ("1792x1024", "1024x1792"):
+            return "dall-e-3"
+        return "dall-e-2"
+
+    @property
+    def max_batch(self):
+        return 1 if self.image_model == "dall-e-3" else self.images_per_request
+
+    @property
+    def cost_per_image(self):
+        return PRICES.get((self.image_model, self.quality, self.size), 0.0)
+
+    def ask_batch(self, prompt, negative_prompt, paths, token=None, on_progress=None):
+        if not transport.http2:
+            # let the SDK share our keep-alive pool for api.openai.com
+            openai.requestssession = lambda: transport.session(openai.api_base)
+        options = {}
+        if self.image_model == "dall-e-3":
+            options = {"model": "dall-e-3", "quality": self.quality}
         try:
-            print("Prompt:", prompt)
-            response = openai.Image.create(
-                prompt=prompt, n=1, size="1024x1024"
-            )
-            image_url = response["data"][0]["url"]
-            image_bytes = requests.get(image_url).content
+            with metrics.span(self.slug, "request"):
+                # the images come inline, which saves a second connection
+                # and round trip to the storage host for each of them
+                response = openai.Image.create(
+                    prompt=prompt, n=len(paths), size=self.size,
+                    response_format="b64_json",
+                    request_timeout=transport.timeout,
+                    **options,
+                )
         except openai.error.AuthenticationError:
-            print("No API key")
-            self.no_api_key()
-            return ""
+            raise AuthError()
+        except openai.error.RateLimitError as e:
+            raise QuotaError(
+                retry_after=(e.headers or {}).get("Retry-After"),
+                retryable=e.code != "insufficient_quota",
+            )
+        except (openai.error.APIConnectionError, openai.error.Timeout):
+            raise NetworkError()
         except openai.error.OpenAIError as e:
-            print("Invalid request")
-            self.win.banner.props.title = e.error["message"]
-            self.win.banner.props.button_label = ""
-            self.win.banner.set_revealed(True)
-            return ""
-        except openai.error.RateLimitError:
-            print("Rate limit")
-            self.win.banner.props.title = "You exceeded your current quota, please check your plan and billing details."
-            self.win.banner.props.button_label = ""
-            self.win.banner.set_revealed(True)
-            return ""
-        except socket.gaierror:
-            self.no_connection()
-            return ""
-        else:
-            self.hide_banner()
-            if image_bytes:
+            if (e.http_status or 0) >= 500:
+                raise ServerError(
+                    e.user_message, e.http_status, (e.headers or {}).get("Retry-After")
+                )
+            raise ProviderError(e.user_message)
+
+        if token is not None:
+            token.raise_if_cancelled()
+        images = []
+        for item, path in zip(response["data"], paths):
+            with metrics.span(self.slug, "download"):
                 try:
-                    return Image.open(io.BytesIO(image_bytes))
-                except UnidentifiedImageError:
-                    error = json.loads(image_bytes)["error"]
-                    self.win.banner.set_title(error)
-                    self.win.banner.set_revealed(True)
-                    return None
-            else:
-                return None
+                    data = base64.b64decode(item["b64_json"], validate=True)
+                except (KeyError, binascii.Error):
+                    data = b""
+                if image_format(data[:12]) is None:
+                    raise ProviderError(_("The provider did not return an image"))
+                if on_progress is not None:  # inline images arrive in one piece
+                    on_progress(path, data, len(data))
+                images.append(save_bytes(data, path))
+        return images
+
+    def params(self):
+        return {"size": self.size, "quality": self.quality}
 
+    @property
+    def api_key(self):
+        return openai.api_key
 
     @property
     def require_api_key(self):
         return True
 
     def preferences(self, win):
+        from gi.repository import Adw, Gtk
+
         self.pref_win = win
 
         self.expander = Adw.ExpanderRow()
@@ -81,16 +137,60 @@ class OpenAIProvider(ImaginerProvider):
         self.api_row.add_suffix(self.how_to_get_a_token())
         self.expander.add_row(self.api_row)
 
+        self.size_row = Adw.ComboRow()
+        self.size_row.props.title = _("Size")
+        self.size_row.set_model(Gtk.StringList.new(SIZES))
+        self.size_row.set_selected(SIZES.index(self.size))
+        self.size_row.connect("notify::selected", self.on_size_selected)
+        self.expander.add_row(self.size_row)
+
+        self.quality_row = Adw.ComboRow()
+        self.quality_row.props.title = _("Quality")
+        self.quality_row.props.subtitle = _("HD and wide sizes use DALL·E 3, one image per request")
+        self.quality_row.set_model(Gtk.StringList.new([_("Standard"), _("HD")]))
+        self.quality_row.set_selected(QUALITIES.index(self.quality))
+        self.quality_row.connect("notify::selected", self.on_quality_selected)
+        self.expander.add_row(self.quality_row)
+
+        self.batch_row = Adw.ActionRow()
+        self.batch_row.props.title = _("Images per Request")
+        spin = Gtk.SpinButton.new_with_range(1, 10, 1)
+        spin.set_value(self.images_per_request)
+        spin.set_valign(Gtk.Align.CENTER)
+        spin.connect("value-changed", self.on_batch_changed)
+        self.batch_row.add_suffix(spin)
+        self.expander.add_row(self.batch_row)
+
         return self.expander
 
+    def on_size_selected(self, row, *args):
+        self.size = SIZES[row.get_selected()]
+
+    def on_quality_selected(self, row, *args):
+        self.quality = QUALITIES[row.get_selected()]
+
+    def on_batch_changed(self, spin):
+        self.images_per_request = spin.get_value_as_int()
+
     def on_apply(self, widget):
         self.hide_banner()
         api_key = self.api_row.get_text()
         openai.api_key = api_key
 
     def save(self):
-        return {"api_key": openai.api_key}
+        return {
+            "api_key": openai.api_key,
+            "size": self.size,
+            "quality": self.quality,
+            "images_per_request": self.images_per_request,
+        }
 
     def load(self, data):
-        if data["api_key"]:
+        if data.get("api_key"):
             openai.api_key = data["api_key"]
+        if data.get("size") in SIZES:
+            self.size = data["size"]
+        if data.get("quality") in QUALITIES:
+            self.quality = data["quality"]
+        if data.get("images_per_request"):
+            self.images_per_request = max(1, min(10, int(data["images_per_request"])))
@@ -0,0 +1,126 @@
+import os
+
+SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+]
+
+
+class NotAnImage(Exception):
+    """The response body is not an image, usually a JSON error instead."""
+
+    def __init__(self, data):
+        super().__init__("Response is not an image")
+        self.data = data
+
+
+class ImageResult:
+    """An image written to disk, with the bytes it was written from.
+
+    `derivatives` are the paths of smaller copies made by post-processing.
+    """
+
+    def __init__(self, path, data, format, derivatives=None):
+        self.path = path
+        self.data = data
+        self.format = format
+        self.derivatives = derivatives or []
+
+
+def image_format(header):
+    """Return the file extension matching the magic bytes of `header`."""
+    for signature, format in SIGNATURES:
+        if header.startswith(signature):
+            return format
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[4:8] == b"ftyp" and header[8:12] in (b"avif", b"avis"):
+        return "avif"
+    return None
+
+
+def output_path(path, format):
+    return f"{os.path.splitext(path)[0]}.{format}"
+
+
+def is_progressive(header):
+    """Whether an image can be previewed before it is complete.
+
+    True for interlaced PNGs and progressive JPEGs, which are sent as a
+    series of passes of increasing resolution.
+    """
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return len(header) > 28 and header[28] == 1  # IHDR interlace method
+    if header.startswith(b"\xff\xd8"):
+        return b"\xff\xc2" in header  # SOF2, progressive DCT
+    return False
+
+
+def save_stream(chunks, path, on_chunk=None):
+    """Write `chunks` to disk as they arrive, in their original encoding.
+
+    Only the magic bytes are checked, the image is never decoded. The file
+    is written next to `path` and renamed once complete, with the extension
+    replaced to match the actual format. `on_chunk(chunk)` sees every chunk
+    as it arrives.
+    """
+    if on_chunk is not None:
+        chunks = _tap(chunks, on_chunk)
+    data = bytearray()
+    chunks = iter(chunks)
+    for chunk in chunks:
+        data += chunk
+        if len(data) >= 12:
+            break
+    format = image_format(bytes(data[:12]))
+    if format is None:
+        for chunk in chunks:
+            data += chunk
+        raise NotAnImage(bytes(data))
+
+    tmp = f"{path}.part"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            for chunk in chunks:
+                f.write(chunk)
+                data += chunk
+        path = output_path(path, format)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    return ImageResult(path, bytes(data), format)
+
+
+def _tap(chunks, callback):
+    for chunk in chunks:
+        callback(chunk)
+        yield chunk
+
+
+def save_bytes(data, path):
+    return save_stream([data], path)
+
+
+def load_output(path):
+    """Return the `ImageResult` already written for `path`, or None.
+
+    Finished files are only ever created by renaming, so any file found
+    here is complete, whatever extension the provider's format gave it.
+    """
+    formats = {format for _, format in SIGNATURES} | {"webp", "avif"}
+    for format in sorted(formats):
+        try:
+            with open(output_path(path, format), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+        if image_format(data[:12]) == format:
+            return ImageResult(output_path(path, format), data, format)
+    return None
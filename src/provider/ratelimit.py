@@ -0,0 +1,118 @@
+import hashlib
+import threading
+import time
+from collections import deque
+
+
+def key_id(provider):
+    """Identify the provider and API key a request is billed to.
+
+    Only a short hash of the key is kept, so it can be logged and stored
+    in the usage ledger without leaking the key itself.
+    """
+    api_key = getattr(provider, "api_key", None)
+    if not api_key:
+        return f"{provider.slug}:anonymous"
+    return f"{provider.slug}:{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]}"
+
+
+class _Lane:
+    """Token bucket and concurrency cap of a single provider and API key."""
+
+    def __init__(self, requests_per_minute, concurrency):
+        self.rate = requests_per_minute / 60.0
+        self.burst = max(1.0, float(concurrency or 1))
+        self.concurrency = concurrency
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.active = 0
+        self.queue = deque()
+        self.cond = threading.Condition()
+
+    def delay(self):
+        """Take a token and return 0, or return how long until there is one."""
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Queues requests so that no API key goes over its limits.
+
+    Every provider and API key pair gets a token bucket refilled at
+    `requests_per_minute` and at most `concurrency` requests in flight;
+    zero disables either limit. Callers wait their turn in the order they
+    arrived instead of failing, and a cancelled token leaves the queue.
+    """
+
+    def __init__(self, requests_per_minute=0, concurrency=0):
+        self.requests_per_minute = requests_per_minute
+        self.concurrency = concurrency
+        self.lanes = {}
+        self._lock = threading.Lock()
+
+    def lane(self, provider):
+        key = key_id(provider)
+        with self._lock:
+            if key not in self.lanes:
+                self.lanes[key] = _Lane(self.requests_per_minute, self.concurrency)
+            return self.lanes[key]
+
+    def acquire(self, provider, token=None, on_wait=None):
+        """Block until `provider` may send a request and return its lane.
+
+        `on_wait(None, seconds)` is called when the request has to wait
+        for the bucket to refill, like a retry with no error.
+        """
+        lane = self.lane(provider)
+        ticket = object()
+
+        def wake():
+            with lane.cond:
+                lane.cond.notify_all()
+
+        if token is not None:
+            token.add_callback(wake)
+        try:
+            with lane.cond:
+                lane.queue.append(ticket)
+                try:
+                    while True:
+                        if token is not None:
+                            token.raise_if_cancelled()
+                        delay = None
+                        if lane.queue[0] is ticket and (
+                            not lane.concurrency or lane.active < lane.concurrency
+                        ):
+                            delay = lane.delay()
+                            if not delay:
+                                lane.active += 1
+                                return lane
+                            if on_wait is not None:
+                                on_wait(None, delay)
+                        lane.cond.wait(delay)
+                finally:
+                    lane.queue.remove(ticket)
+                    lane.cond.notify_all()
+        finally:
+            if token is not None:
+                token.remove_callback(wake)
+
+    def release(self, lane):
+        with lane.cond:
+            lane.active -= 1
+            lane.cond.notify_all()
+
+    def call(self, provider, fn, token=None, on_wait=None):
+        """Call `fn()` once `provider` is allowed to send a request."""
+        lane = self.acquire(provider, token, on_wait)
+        try:
+            return fn()
+        finally:
+            self.release(lane)
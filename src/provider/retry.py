@@ -0,0 +1,72 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+from .errors import ModelLoadingError, QuotaError, ServerError
+
+RETRYABLE = (ModelLoadingError, QuotaError, ServerError)
+
+
+def parse_retry_after(value):
+    """Return the seconds to wait from a Retry-After header, or None."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryScheduler:
+    """Retries cold models, rate limits and server errors.
+
+    The wait is the service's own hint (the model's `estimated_time` or a
+    Retry-After header) when there is one, capped at `cap` with up to 10%
+    of jitter, and an exponential backoff with full jitter otherwise.
+    Quotas that are used up are not retried, and nothing is retried once
+    the next attempt would start after `deadline` seconds.
+    """
+
+    def __init__(self, deadline=120, base=1.0, cap=30.0):
+        self.deadline = deadline
+        self.base = base
+        self.cap = cap
+
+    def delay(self, error, attempt):
+        if isinstance(error, ModelLoadingError):
+            hint = error.estimated_time
+        else:
+            hint = parse_retry_after(error.retry_after)
+        if hint is not None:
+            return min(self.cap, hint) * random.uniform(1.0, 1.1)
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def call(self, fn, token=None, on_wait=None):
+        """Call `fn()` until it succeeds, fails for good or runs out of time.
+
+        `on_wait(error, seconds)` is called before each wait, to show a
+        countdown instead of an error.
+        """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except RETRYABLE as e:
+                if isinstance(e, QuotaError) and not e.retryable:
+                    raise
+                delay = self.delay(e, attempt)
+                if time.monotonic() - start + delay > self.deadline:
+                    raise
+                if on_wait is not None:
+                    on_wait(e, delay)
+                if token is not None:
+                    if token.wait(delay):
+                        token.raise_if_cancelled()
+                else:
+                    time.sleep(delay)
+                attempt += 1
@@ -0,0 +1,318 @@
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .cancel import Cancelled
+from .errors import NetworkError
+from .metrics import metrics
+
+try:
+    import httpx
+    import h2  # noqa: F401, httpx.Client(http2=True) raises ImportError without it
+except ImportError:  # HTTP/2 is optional, the requests session is used instead
+    httpx = None
+
+NETWORK_ERRORS = (requests.ConnectionError, requests.Timeout)
+if httpx is not None:
+    NETWORK_ERRORS += (httpx.TransportError,)
+
+_local = threading.local()
+
+
+def _shutdown(connection):
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            # the plain socket call, SSLSocket.shutdown() would also drop
+            # the TLS state under the thread still reading from it
+            socket.socket.shutdown(sock, socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class _PendingRequest:
+    """The connection a request is sent on, shut down if its token fires.
+
+    Closing a response only helps once the headers have arrived, and most
+    of a generation is spent waiting for them. Shutting the socket down
+    wakes the worker blocked in that wait instead.
+    """
+
+    def __init__(self):
+        self.connection = None
+        self.aborted = False
+        self._lock = threading.Lock()
+
+    def attach(self, connection):
+        with self._lock:
+            self.connection = connection
+            aborted = self.aborted
+        if aborted:
+            _shutdown(connection)
+
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            connection = self.connection
+        if connection is not None:
+            _shutdown(connection)
+
+
+class _ConnectionMixin:
+    """Hands the connection to the pending request of the sending thread.
+
+    New connections are timed too: the "connect" and "tls" stages of the
+    host tell a slow network apart from a slow service in "request".
+    """
+
+    connect_time = 0.0
+
+    def _attach(self):
+        pending = getattr(_local, "pending", None)
+        if pending is not None:
+            pending.attach(self)
+
+    def _new_conn(self):
+        start = time.monotonic()
+        sock = super()._new_conn()
+        self.connect_time = time.monotonic() - start
+        metrics.observe(self.host, "connect", self.connect_time)
+        return sock
+
+    def connect(self):
+        start = time.monotonic()
+        super().connect()
+        if isinstance(self, HTTPSConnection):
+            metrics.observe(self.host, "tls", time.monotonic() - start - self.connect_time)
+        self._attach()
+
+    def request(self, *args, **kwargs):
+        self._attach()
+        return super().request(*args, **kwargs)
+
+
+class _HTTPConnection(_ConnectionMixin, HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_ConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _HTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+class _Adapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _HTTPConnectionPool,
+            "https": _HTTPSConnectionPool,
+        }
+
+
+class Transport:
+    """Pooled, keep-alive HTTP client shared by every provider.
+
+    One session is kept per host so that back-to-back generations reuse
+    the same TCP/TLS connection instead of paying a new handshake each time.
+    """
+
+    def __init__(self, pool_size=4, connect_timeout=10, read_timeout=120, http2=False):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.http2 = http2 and httpx is not None
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def configure(self, pool_size=None, connect_timeout=None, read_timeout=None, http2=None):
+        """Update the settings, dropping pools that no longer match."""
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if read_timeout is not None:
+            self.read_timeout = read_timeout
+        if http2 is not None:
+            self.http2 = http2 and httpx is not None
+        self.close()
+
+    def session(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            try:
+                return self._sessions[host]
+            except KeyError:
+                session = self._new_session()
+                self._sessions[host] = session
+                return session
+
+    def _new_session(self):
+        if self.http2:
+            return httpx.Client(
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                ),
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+            )
+        session = requests.Session()
+        adapter = _Adapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def request(self, method, url, token=None, stream=False, **kwargs):
+        """Send a request through the pooled session for `url`'s host.
+
+        When a cancel token is given, firing it aborts the request: the
+        socket is shut down while the headers are awaited, and the response
+        is closed once they arrived, which stops a body download.
+        With `stream=True` the body of a successful response is left unread
+        for `chunks()`; error bodies are always loaded.
+        """
+        if token is not None:
+            token.raise_if_cancelled()
+        session = self.session(url)
+        try:
+            if self.http2:
+                if isinstance(kwargs.get("data"), (str, bytes)):
+                    kwargs["content"] = kwargs.pop("data")
+                response = self._send_http2(session, session.build_request(method, url, **kwargs), token)
+            else:
+                kwargs.setdefault("timeout", self.timeout)
+                response = self._send(session, method, url, token, **kwargs)
+        except NETWORK_ERRORS as e:
+            if token is not None and token.cancelled:
+                raise Cancelled(token.reason) from e
+            raise NetworkError() from e
+
+        if stream and response.status_code == 200:
+            if token is not None:
+                token.add_callback(response.close)
+            return response
+
+        if token is not None:
+            token.add_callback(response.close)
+        try:
+            if self.http2:
+                response.read()
+            else:
+                response.content  # loads the whole body
+        except Exception as e:
+            if token is not None and token.cancelled:
+                raise Cancelled(token.reason) from e
+            if isinstance(e, NETWORK_ERRORS):
+                raise NetworkError() from e
+            raise
+        finally:
+            if token is not None:
+                token.remove_callback(response.close)
+        if token is not None:
+            token.raise_if_cancelled()
+        return response
+
+    def _send(self, session, method, url, token, **kwargs):
+        if token is None:
+            return session.request(method, url, stream=True, **kwargs)
+        _local.pending = pending = _PendingRequest()
+        token.add_callback(pending.abort)
+        try:
+            return session.request(method, url, stream=True, **kwargs)
+        finally:
+            _local.pending = None
+            token.remove_callback(pending.abort)
+
+    def _send_http2(self, session, request, token):
+        """Send on a helper thread, so that the wait for headers can be given up.
+
+        An HTTP/2 stream cannot be reset from here, so a cancelled request
+        is left to finish on its own and its response closed on arrival.
+        """
+        if token is None:
+            return session.send(request, stream=True)
+        outcome = []
+        given_up = []
+        finished = threading.Event()
+        lock = threading.Lock()
+
+        def send():
+            try:
+                response = session.send(request, stream=True)
+            except Exception as e:
+                response = e
+            with lock:
+                outcome.append(response)
+                abandoned = bool(given_up)
+            finished.set()
+            if abandoned and not isinstance(response, Exception):
+                response.close()
+
+        token.add_callback(finished.set)
+        threading.Thread(target=send, daemon=True, name="imaginer-http2").start()
+        finished.wait()
+        token.remove_callback(finished.set)
+        with lock:
+            if not outcome:
+                given_up.append(True)
+                raise Cancelled(token.reason)
+        if isinstance(outcome[0], Exception):
+            raise outcome[0]
+        return outcome[0]
+
+    def chunks(self, response, token=None, chunk_size=64 * 1024):
+        """Iterate over the body of a streamed response."""
+        if self.http2:
+            iterator = response.iter_bytes(chunk_size)
+        else:
+            iterator = response.iter_content(chunk_size)
+        try:
+            for chunk in iterator:
+                if token is not None:
+                    token.raise_if_cancelled()
+                yield chunk
+        except Cancelled:
+            raise
+        except Exception as e:
+            if token is not None and token.cancelled:
+                raise Cancelled(token.reason) from e
+            if isinstance(e, NETWORK_ERRORS):
+                raise NetworkError() from e
+            raise
+        finally:
+            if token is not None:
+                token.remove_callback(response.close)
+            response.close()
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+transport = Transport()
@@ -0,0 +1,206 @@
+# routing.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+
+import queue
+import threading
+import time
+from collections import deque
+
+from gettext import gettext as _
+
+from .jobs import JobState
+from .provider.cancel import Cancelled
+from .provider.errors import ProviderError
+
+AUTO = "auto"
+
+
+class _History:
+    """Latest outcomes of one provider."""
+
+    def __init__(self, size):
+        self.latencies = deque(maxlen=size)
+        self.errors = deque(maxlen=size)
+
+    def percentile(self, q):
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+class Router:
+    """Picks the provider of the automatic choice from recent generations.
+
+    The latencies and failures of the latest `window` generations of each
+    provider are kept. Healthy providers, which failed less than
+    `max_error_rate` of the time, come first, fastest median first, and
+    providers never tried yet before the ones that are known to be slow.
+    With `hedge`, a request still running past the p95 latency of its
+    provider is sent to the next provider too, and the first image wins;
+    the time the losers had run is kept as a lower bound of their latency.
+    Attempts are jobs of `engine`, which must not be the engine running
+    `run()` itself, or its workers could all end up waiting on attempts.
+    """
+
+    def __init__(self, engine, window=50, max_error_rate=0.5, min_samples=5, hedge=True):
+        self.engine = engine
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.hedge = hedge
+        self.history = {}
+        self._lock = threading.Lock()
+
+    def _history(self, slug):
+        if slug not in self.history:
+            self.history[slug] = _History(self.window)
+        return self.history[slug]
+
+    def record(self, slug, latency=None, error=None):
+        with self._lock:
+            history = self._history(slug)
+            history.errors.append(error is not None)
+            if error is None:
+                history.latencies.append(latency)
+
+    def healthy(self, slug):
+        with self._lock:
+            errors = self._history(slug).errors
+            return not errors or sum(errors) / len(errors) < self.max_error_rate
+
+    def p50(self, slug):
+        with self._lock:
+            history = self._history(slug)
+            return history.percentile(0.5) if history.latencies else 0.0
+
+    def p95(self, slug):
+        """The p95 latency of `slug`, or None while it has too few samples."""
+        with self._lock:
+            history = self._history(slug)
+            if len(history.latencies) < self.min_samples:
+                return None
+            return history.percentile(0.95)
+
+    def rank(self, providers, loading=()):
+        """Sort `providers` from the best choice to the worst.
+
+        Providers whose slug is in `loading` have a cold model and come
+        after the others that are healthy.
+        """
+        return sorted(
+            providers,
+            key=lambda p: (not self.healthy(p.slug), p.slug in loading, self.p50(p.slug)),
+        )
+
+    def run(self, providers, fn, token=None, loading=(), discard=None):
+        """Call `fn(provider, token)` with the best provider and return `(provider, result)`.
+
+        Runs on a worker thread. If the provider fails, the next one is
+        tried; if it is slower than usual and hedging is on, the next one
+        is started alongside it and whichever loses is cancelled. A loser
+        that still returns, or any attempt returning once `token` was
+        cancelled, is passed to `discard(provider, result)` to undo what
+        it wrote. The last error is raised if every provider failed.
+        """
+        ranked = self.rank(providers, loading)
+        if not ranked:
+            raise ProviderError(_("No provider is enabled"))
+        outcomes = queue.Queue()
+        attempts = {}
+        parent = token  # attempts get a token of their own
+        winner = []
+        lock = threading.Lock()
+
+        def attempt(provider, token):
+            sent = time.monotonic()
+            result = fn(provider, token)
+            with lock:
+                won = not winner and not (parent is not None and parent.cancelled)
+                if won:
+                    winner.append(provider.slug)
+            if not won:
+                if discard is not None:
+                    discard(provider, result)
+                raise Cancelled("hedged")
+            self.record(provider.slug, latency=time.monotonic() - sent)
+            return result
+
+        def on_finish(job):
+            if job.state == JobState.FAILED:  # errors and deadlines, not cancellations
+                self.record(job.args[0].slug, error=job.error)
+            outcomes.put(job)
+
+        def start(provider):
+            attempts[provider.slug] = self.engine.submit(attempt, provider, on_finish=on_finish)
+
+        def cancel_others(winner, reason):
+            for slug, job in attempts.items():
+                if slug != winner:
+                    if job.started is not None and not job.done:
+                        record_lower_bound(slug, time.monotonic() - job.started)
+                    job.cancel(reason)
+
+        def record_lower_bound(slug, elapsed):
+            # a cancelled attempt would have taken at least `elapsed`: left
+            # out, a provider that became slow would keep its old median
+            # and be tried first forever; below the median it says nothing
+            if elapsed > self.p50(slug):
+                self.record(slug, latency=elapsed)
+
+        on_cancel = lambda: outcomes.put(None)
+        if token is not None:
+            token.add_callback(on_cancel)
+        try:
+            pending = list(ranked)
+            began = time.monotonic()
+            hedge_after = self.p95(ranked[0].slug) if self.hedge else None
+            start(pending.pop(0))
+            running = 1
+            error = None
+            while running:
+                timeout = None
+                if hedge_after is not None and pending:
+                    timeout = max(0.0, began + hedge_after - time.monotonic())
+                try:
+                    outcome = outcomes.get(timeout=timeout)
+                except queue.Empty:  # slower than usual, race the next provider
+                    print("Hedging with", pending[0].slug)
+                    hedge_after = None
+                    start(pending.pop(0))
+                    running += 1
+                    continue
+                if outcome is None:
+                    token.raise_if_cancelled()
+                provider = outcome.args[0]
+                running -= 1
+                if outcome.state == JobState.DONE:
+                    cancel_others(provider.slug, "hedged")
+                    return provider, outcome.result
+                error = outcome.error or Cancelled(outcome.token.reason)
+                if not running and pending and not isinstance(error, Cancelled):
+                    began = time.monotonic()
+                    hedge_after = self.p95(pending[0].slug) if self.hedge else None
+                    start(pending.pop(0))
+                    running += 1
+            raise error
+        finally:
+            if token is not None:
+                token.remove_callback(on_cancel)
+                if token.cancelled:
+                    cancel_others(None, token.reason)
@@ -0,0 +1,100 @@
+# singleflight.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import threading
+
+from .provider.cancel import CancelToken
+
+
+class _Call:
+    def __init__(self):
+        self.token = CancelToken()
+        self.done = threading.Event()
+        self.waiters = 0
+        self.wakers = []
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces identical calls that are in flight at the same time.
+
+    The first caller for a key runs the function; later callers with the
+    same key wait for it and receive the same result. The function gets
+    its own cancel token, which is only cancelled once every caller has
+    given up on the call.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    def do(self, key, fn, token=None):
+        woken = threading.Event()
+        detached = []
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            call.waiters += 1
+            call.wakers.append(woken)
+
+        def detach():
+            woken.set()
+            with self._lock:
+                if detached:
+                    return
+                detached.append(True)
+                call.waiters -= 1
+                abandoned = call.waiters == 0 and not call.done.is_set()
+                if abandoned and self._calls.get(key) is call:
+                    del self._calls[key]
+            if abandoned:
+                call.token.cancel(token.reason if token is not None else "cancelled")
+
+        if token is not None:
+            token.add_callback(detach)
+        try:
+            if leader:
+                try:
+                    call.result = fn(call.token)
+                except Exception as e:
+                    call.error = e
+                finally:
+                    with self._lock:
+                        if self._calls.get(key) is call:
+                            del self._calls[key]
+                        call.done.set()
+                    for waker in call.wakers:
+                        waker.set()
+            else:
+                woken.wait()
+        finally:
+            if token is not None:
+                token.remove_callback(detach)
+                token.raise_if_cancelled()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
@@ -0,0 +1,86 @@
+# thumbnails.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import io
+import os
+import tempfile
+
+from .xdg import cache_dir
+
+
+class ThumbnailCache:
+    """Small JPEG previews of output images, generated on demand.
+
+    Thumbnails are keyed by the image's path, modification time and the
+    thumbnail size, so an overwritten image gets a new one; stale entries
+    are simply never read again. Decoding uses Pillow's `draft()` and
+    `reduce()`, which let JPEGs decode at a fraction of their size and
+    shrink other formats by whole factors before the final resampling.
+    """
+
+    def __init__(self, directory=None, size=256):
+        self.directory = directory or cache_dir("thumbnails")
+        self.size = size
+
+    def key(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        data = f"{os.path.abspath(path)}\0{mtime}\0{self.size}"
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.jpg")
+
+    def get(self, path):
+        """Return the JPEG bytes of the thumbnail of `path`, making it if needed.
+
+        Runs on worker threads; raises OSError if the image is gone.
+        """
+        entry = self._entry(self.key(path))
+        try:
+            with open(entry, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        data = self.make(path)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, entry)
+        except OSError:
+            os.unlink(tmp)
+            raise
+        return data
+
+    def make(self, path):
+        from PIL import Image
+
+        with Image.open(path) as image:
+            image.draft("RGB", (self.size, self.size))
+            factor = min(image.width, image.height) // self.size
+            if factor > 1:
+                image = image.reduce(factor)
+            image.thumbnail((self.size, self.size))
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            output = io.BytesIO()
+            image.save(output, "JPEG", quality=85)
+        return output.getvalue()
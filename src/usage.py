@@ -0,0 +1,94 @@
+# usage.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import datetime
+import json
+import os
+import tempfile
+import threading
+
+from .provider.ratelimit import key_id
+from .xdg import data_dir
+
+
+class UsageLedger:
+    """Requests, images and estimated cost per API key and per day.
+
+    The ledger is a small JSON file under $XDG_DATA_HOME, rewritten
+    atomically after every request so that the numbers survive crashes
+    and are shared by the application and the command line. Days older
+    than `keep_days` are dropped.
+    """
+
+    def __init__(self, path=None, keep_days=90):
+        self.path = path or os.path.join(data_dir(), "usage.json")
+        self.keep_days = keep_days
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _write(self, data):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+    def record(self, provider, requests=1, images=0):
+        """Add a request and the images it returned to today's entry."""
+        today = datetime.date.today()
+        oldest = (today - datetime.timedelta(days=self.keep_days)).isoformat()
+        with self._lock:
+            data = self._read()
+            for day in [day for day in data if day < oldest]:
+                del data[day]
+            entry = data.setdefault(today.isoformat(), {}).setdefault(
+                key_id(provider), {"requests": 0, "images": 0, "cost": 0.0}
+            )
+            entry["requests"] += requests
+            entry["images"] += images
+            entry["cost"] += images * provider.cost_per_image
+            try:
+                self._write(data)
+            except OSError as e:
+                print("Could not save the usage ledger:", e)
+
+    def summary(self, days=30):
+        """Return `{key: {"requests", "images", "cost"}}` over the last `days`."""
+        oldest = (datetime.date.today() - datetime.timedelta(days=days - 1)).isoformat()
+        totals = {}
+        with self._lock:
+            data = self._read()
+        for day, keys in data.items():
+            if day < oldest:
+                continue
+            for key, entry in keys.items():
+                total = totals.setdefault(key, {"requests": 0, "images": 0, "cost": 0.0})
+                for field in total:
+                    total[field] += entry.get(field, 0)
+        return totals
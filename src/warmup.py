@@ -0,0 +1,90 @@
+# warmup.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+
+from .jobs import JobState
+
+COLD = "cold"
+LOADING = "loading"
+WARM = "warm"
+
+
+class Warmup:
+    """Keeps track of which models are loaded on the inference side.
+
+    `warm()` checks each provider on the job engine and wakes its model up
+    if it was unloaded; a loaded model is left alone, as only a generation
+    would keep it loaded. At most one check runs at a time per provider,
+    through the optional rate limiter and counted in the optional usage
+    ledger. The state of a provider is also updated from the outcome of
+    real generations with `mark()`, and None means it is unknown.
+    `on_change(slug, state)` is called through the engine's dispatch.
+    """
+
+    def __init__(self, engine, on_change=None, limiter=None, ledger=None):
+        self.engine = engine
+        self.on_change = on_change
+        self.limiter = limiter
+        self.ledger = ledger
+        self.states = {}
+        self._jobs = {}
+
+    def state(self, slug):
+        return self.states.get(slug)
+
+    def mark(self, slug, state):
+        if self.states.get(slug) == state:
+            return
+        if state is None:
+            del self.states[slug]
+        else:
+            self.states[slug] = state
+        if self.on_change is not None:
+            self.on_change(slug, state)
+
+    def warm(self, providers):
+        for provider in providers:
+            job = self._jobs.get(provider.slug)
+            if job is not None and not job.done:
+                continue
+            self._jobs[provider.slug] = self.engine.submit(
+                self._warm_up,
+                provider,
+                on_state=lambda job, state, slug=provider.slug: self._on_state(slug, job, state),
+            )
+
+    def _warm_up(self, provider, token=None):
+        try:
+            if self.limiter is None:
+                return provider.warm_up(token=token)
+            return self.limiter.call(provider, lambda: provider.warm_up(token=token), token)
+        finally:
+            if self.ledger is not None:
+                self.ledger.record(provider)
+
+    def _on_state(self, slug, job, state):
+        if state == JobState.DONE:
+            self.mark(slug, job.result)
+        elif state == JobState.FAILED:
+            print("Could not warm up", slug, job.error)
+            self.mark(slug, None)
+
+    def cancel(self):
+        for job in self._jobs.values():
+            job.cancel()
@@ -0,0 +1,91 @@
+# watchdog.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import sys
+import threading
+import time
+import traceback
+
+from gi.repository import GLib
+
+from .provider.metrics import metrics
+
+
+class Watchdog:
+    """Reports main loop dispatches that block for longer than `threshold`.
+
+    A high priority timeout stamps a heartbeat every `interval` seconds.
+    A thread checks it, and once it is late by more than `threshold`,
+    prints the Python stack the main thread is stuck in, which is the
+    callback being dispatched. When the loop comes back, the length of
+    the stall is printed and recorded as the "stall" stage of the
+    metrics.
+    """
+
+    def __init__(self, threshold=0.2, interval=0.05):
+        self.threshold = threshold
+        self.interval = interval
+        self.last = time.monotonic()
+        self.stalled = False
+        self.stalls = 0
+        self._stop = threading.Event()
+        self._source = None
+        self._main = None
+
+    def start(self):
+        """Start watching the loop of the calling thread, which must be the main one."""
+        self._main = threading.get_ident()
+        self.last = time.monotonic()
+        self._source = GLib.timeout_add(
+            int(self.interval * 1000), self._beat, priority=GLib.PRIORITY_HIGH
+        )
+        threading.Thread(target=self._watch, daemon=True, name="imaginer-watchdog").start()
+        return self
+
+    def _beat(self):
+        now = time.monotonic()
+        if self.stalled:
+            duration = now - self.last
+            self.stalled = False
+            metrics.observe("window", "stall", duration)
+            print(f"Main loop was blocked for {duration * 1000:.0f} ms", file=sys.stderr)
+        self.last = now
+        return GLib.SOURCE_CONTINUE
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            late = time.monotonic() - self.last
+            if late < self.threshold or self.stalled:
+                continue
+            frame = sys._current_frames().get(self._main)
+            if frame is None:
+                continue
+            self.stalled = True
+            self.stalls += 1
+            stack = "".join(traceback.format_stack(frame))
+            print(
+                f"Main loop blocked for more than {late * 1000:.0f} ms in:\n{stack}",
+                file=sys.stderr,
+            )
+
+    def stop(self):
+        self._stop.set()
+        if self._source:
+            GLib.source_remove(self._source)
+            self._source = None
@@ -17,8 +17,16 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import io
+
 from gi.repository import Adw
-from gi.repository import Gtk, Gio
+from gi.repository import Gtk, Gdk, Gio, GLib
+
+from gettext import gettext as _
+
+from .history import HistoryFactory
+from .provider.errors import AuthError, ModelLoadingError, QuotaError
+from .provider.metrics import metrics
 
 
 @Gtk.Template(resource_path="/page/codeberg/Imaginer/Imaginer/ui/window.ui")
@@ -29,13 +37,23 @@ class ImaginerWindow(Adw.ApplicationWindow):
     banner = Gtk.Template.Child()
     stack_imaginer = Gtk.Template.Child()
     image = Gtk.Template.Child()
+    gallery = Gtk.Template.Child()
+    label_progress = Gtk.Template.Child()
+    spin_count = Gtk.Template.Child()
+    switch_compare = Gtk.Template.Child()
     button_output = Gtk.Template.Child()
     button_imagine = Gtk.Template.Child()
     spinner = Gtk.Template.Child()
+    status_loading = Gtk.Template.Child()
+    preview = Gtk.Template.Child()
     prompt = Gtk.Template.Child()
     negative_prompt = Gtk.Template.Child()
     menu = Gtk.Template.Child()
     label_output = Gtk.Template.Child()
+    row_provider = Gtk.Template.Child()
+    button_history = Gtk.Template.Child()
+    history_grid = Gtk.Template.Child()
+    history_search = Gtk.Template.Child()
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -45,6 +63,11 @@ class ImaginerWindow(Adw.ApplicationWindow):
             raise ValueError("Application should be passed to ImaginerWindow")
         self.app = app
 
+        # generations started from this window, stopped with it
+        self.running = []
+        self.queued = []
+        self.file_path = None
+
         self.settings = Gio.Settings(schema_id="page.codeberg.Imaginer.Imaginer")
 
         self.settings.bind(
@@ -59,3 +82,205 @@ class ImaginerWindow(Adw.ApplicationWindow):
         self.settings.bind(
             "is-fullscreen", self, "fullscreened", Gio.SettingsBindFlags.DEFAULT
         )
+
+    def track(self, job, queued):
+        """Keep a batch or job group started from this window, with its job queue ids."""
+        self.running = [running for running in self.running if not running.done]
+        self.running.append(job)
+        self.queued += queued
+
+    def stop(self):
+        """Cancel every generation of this window, leaving other windows alone."""
+        for job in self.running:
+            job.cancel()
+        self.app.queue.cancel(self.queued)
+        self.running = []
+        self.queued = []
+
+    def set_provider_state(self, name, state=None):
+        """Show the selected provider and whether its model is ready."""
+        states = {
+            "warm": _("Ready"),
+            "loading": _("Loading model"),
+            "cold": _("Cold"),
+        }
+        if state in states:
+            self.row_provider.set_subtitle(f"{name} · {states[state]}")
+        else:
+            self.row_provider.set_subtitle(name)
+
+    def show_error(self, error):
+        """Reveal the banner for a provider error, from any thread."""
+        GLib.idle_add(self._show_error, error)
+
+    def hide_error(self):
+        GLib.idle_add(self.banner.set_revealed, False)
+
+    def _show_error(self, error):
+        title = str(error)
+        if isinstance(error, ModelLoadingError) and error.estimated_time:
+            title = _("{}, try again in {:.0f} seconds").format(error, error.estimated_time)
+        self.banner.props.title = title
+        if isinstance(error, AuthError):
+            self.banner.props.button_label = _("Open settings")
+            self.banner.set_action_name("app.preferences")
+        else:
+            self.banner.props.button_label = ""
+            self.banner.set_action_name(None)
+        self.banner.set_revealed(True)
+
+    def show_countdown(self, error, seconds):
+        """Show the time left before a retry on the loading page."""
+        self.reset_status()
+        if error is None:
+            self.status_loading.set_title(_("Waiting for the rate limit"))
+        elif isinstance(error, ModelLoadingError):
+            self.status_loading.set_title(_("The model is loading"))
+        elif isinstance(error, QuotaError):
+            self.status_loading.set_title(_("Too many requests"))
+        else:
+            self.status_loading.set_title(_("The provider is unavailable"))
+        self.countdown = int(seconds + 0.5)
+
+        def tick():
+            self.status_loading.set_description(
+                (_("Starting in {} seconds") if error is None else _("Retrying in {} seconds")).format(self.countdown)
+            )
+            self.countdown -= 1
+            if self.countdown < 0:
+                self.countdown_source = None
+                return GLib.SOURCE_REMOVE
+            return GLib.SOURCE_CONTINUE
+
+        tick()
+        self.countdown_source = GLib.timeout_add_seconds(1, tick)
+
+    def show_transfer(self, received, total, rate, elapsed, texture=None):
+        """Show how the download is going and the preview decoded so far."""
+        if getattr(self, "countdown_source", None):
+            GLib.source_remove(self.countdown_source)
+            self.countdown_source = None
+        self.status_loading.set_title(_("Downloading"))
+        if total:
+            size = _("{} of {}").format(GLib.format_size(received), GLib.format_size(total))
+        else:
+            size = GLib.format_size(received)
+        self.status_loading.set_description(
+            _("{} · {}/s · {:.0f} s").format(size, GLib.format_size(int(rate)), elapsed)
+        )
+        if texture is not None:
+            self.preview.set_paintable(texture)
+            self.preview.set_visible(True)
+
+    def reset_status(self):
+        if getattr(self, "countdown_source", None):
+            GLib.source_remove(self.countdown_source)
+            self.countdown_source = None
+        self.status_loading.set_title("")
+        self.status_loading.set_description(None)
+        self.preview.set_paintable(None)
+        self.preview.set_visible(False)
+
+    def clear_results(self):
+        self.reset_status()
+        while child := self.gallery.get_first_child():
+            self.gallery.remove(child)
+        self.gallery.set_visible(False)
+        self.label_progress.set_visible(False)
+
+    def texture(self, result):
+        """Build a texture from the bytes the result was written from.
+
+        Formats GdkPixbuf has no loader for, such as AVIF, are decoded by
+        Pillow instead; returns None if neither can read the image.
+        """
+        with metrics.span("window", "decode"):
+            try:
+                return Gdk.Texture.new_from_bytes(GLib.Bytes.new(result.data))
+            except GLib.Error:
+                pass
+            try:
+                from PIL import Image
+
+                with Image.open(io.BytesIO(result.data)) as image:
+                    image = image.convert("RGBA")
+                    return Gdk.MemoryTexture.new(
+                        image.width, image.height, Gdk.MemoryFormat.R8G8B8A8,
+                        GLib.Bytes.new(image.tobytes()), image.width * 4,
+                    )
+            except Exception as e:
+                print(f"Could not show {result.path}: {e}")
+                return None
+
+    def add_result(self, result):
+        """Show `result` as the main image and add it to the batch gallery."""
+        texture = self.texture(result)
+        if texture is None:
+            return
+        self.image.set_paintable(texture)
+        self.image.set_visible(True)
+
+        thumbnail = Gtk.Picture.new_for_paintable(texture)
+        thumbnail.set_size_request(64, 64)
+        thumbnail.texture = texture
+        self.gallery.append(thumbnail)
+        self.gallery.set_visible(self.gallery.get_first_child() != self.gallery.get_last_child())
+
+    def add_provider_result(self, name, result=None, latency=None, error=None):
+        """Add a captioned result of compare mode to the gallery."""
+        card = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        card.texture = self.texture(result) if result else None
+        if card.texture is not None:
+            picture = Gtk.Picture.new_for_paintable(card.texture)
+            picture.set_size_request(128, 128)
+            card.append(picture)
+            self.image.set_paintable(card.texture)
+            self.image.set_visible(True)
+
+        caption = Gtk.Label()
+        caption.set_wrap(True)
+        caption.set_justify(Gtk.Justification.CENTER)
+        if error:
+            status = GLib.markup_escape_text(str(error))
+            caption.add_css_class("error")
+        else:
+            status = _("{:.1f} s").format(latency)
+        caption.set_markup(f"<b>{GLib.markup_escape_text(name)}</b>\n<small>{status}</small>")
+        card.append(caption)
+
+        self.gallery.append(card)
+        self.gallery.set_visible(True)
+
+    def set_progress(self, done, total):
+        self.label_progress.set_label(_("{} of {} images").format(done, total))
+        self.label_progress.set_visible(total > 1)
+
+    @Gtk.Template.Callback()
+    def on_gallery_activated(self, flowbox, child):
+        if child.get_child().texture:
+            self.image.set_paintable(child.get_child().texture)
+
+    @Gtk.Template.Callback()
+    def on_history_toggled(self, button):
+        if button.get_active():
+            if self.history_grid.get_model() is None:
+                self.app.history.load()
+                self.history_grid.set_factory(HistoryFactory(self.app.history))
+                self.history_grid.set_model(Gtk.NoSelection(model=self.app.history.store))
+            self.stack_imaginer.set_visible_child_name("stack_history")
+        elif self.stack_imaginer.get_visible_child_name() == "stack_history":
+            self.stack_imaginer.set_visible_child_name("stack_imagine")
+
+    @Gtk.Template.Callback()
+    def on_history_search_changed(self, entry):
+        text = entry.get_text().strip()
+        if text:
+            model = self.app.history.search(text)
+        else:
+            model = self.app.history.store
+        self.history_grid.set_model(Gtk.NoSelection(model=model))
+
+    @Gtk.Template.Callback()
+    def on_history_activated(self, grid, position):
+        item = grid.get_model().get_item(position)
+        Gio.AppInfo.launch_default_for_uri(Gio.File.new_for_path(item.path).get_uri(), None)
@@ -0,0 +1,41 @@
+# xdg.py
+#
+# Copyright 2023 Me
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+
+from .constants import app_id
+
+
+def _base(variable, fallback):
+    path = os.environ.get(variable) or os.path.expanduser(fallback)
+    return os.path.join(path, app_id)
+
+
+def cache_dir(*parts):
+    """Return (and create) a directory under $XDG_CACHE_HOME for Imaginer."""
+    path = os.path.join(_base("XDG_CACHE_HOME", "~/.cache"), *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def data_dir(*parts):
+    """Return (and create) a directory under $XDG_DATA_HOME for Imaginer."""
+    path = os.path.join(_base("XDG_DATA_HOME", "~/.local/share"), *parts)
+    os.makedirs(path, exist_ok=True)
+    return path